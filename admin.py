@@ -111,7 +111,7 @@ class SetPrio(Command):
 
     def setup_parser(self, parser):
         parser.add_argument('names', nargs='+')
-        parser.add_argument('value')
+        parser.add_argument('value', type=int)
         parser.add_argument('--static', action='store_true')
 
     def execute(self, backend, names, value, static):
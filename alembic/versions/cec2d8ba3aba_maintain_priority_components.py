@@ -0,0 +1,76 @@
+"""Maintain priority components incrementally
+
+Revision ID: cec2d8ba3aba
+Revises: 1d3bd1ceb2d5
+Create Date: 2015-04-20 10:12:31.402117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'cec2d8ba3aba'
+down_revision = '1d3bd1ceb2d5'
+
+import math
+
+from alembic import op
+import sqlalchemy as sa
+
+from koschei.util import config
+
+
+def upgrade():
+    priority_conf = config['priorities']
+    for component in 'dependency', 'time', 'failed':
+        op.add_column('package', sa.Column(component + '_priority',
+                                           sa.Integer(), server_default='0',
+                                           nullable=False))
+    op.execute("""
+               UPDATE package SET dependency_priority = dp.priority
+               FROM (SELECT package_id, SUM({weight} / COALESCE(distance, 8))
+                            AS priority
+                     FROM dependency_change
+                     WHERE applied_in_id IS NULL
+                     GROUP BY package_id) AS dp
+               WHERE package.id = dp.package_id
+               """.format(weight=priority_conf['package_update']))
+    t0 = priority_conf['t0']
+    t1 = priority_conf['t1']
+    a = priority_conf['build_threshold'] / (math.log10(t1) - math.log10(t0))
+    b = -a * math.log10(t0)
+    op.execute("""
+               UPDATE package SET time_priority = ROUND(tp.priority)
+               FROM (SELECT package_id,
+                            GREATEST({a} * LOG(EXTRACT(EPOCH FROM
+                                          NOW() - MAX(started)) / 3600
+                                          + 0.00001) + {b}, -30)
+                            AS priority
+                     FROM build
+                     GROUP BY package_id
+                     HAVING MAX(started) IS NOT NULL) AS tp
+               WHERE package.id = tp.package_id
+               """.format(a=a, b=b))
+    # last build failed and the previous one didn't
+    op.execute("""
+               UPDATE package SET failed_priority = {priority}
+               FROM (SELECT package_id,
+                            ARRAY_AGG(state ORDER BY id DESC) AS states
+                     FROM build
+                     GROUP BY package_id) AS lb
+               WHERE package.id = lb.package_id
+                     AND lb.states[1] = 5 AND lb.states[2] != 5
+               """.format(priority=priority_conf['failed_build_priority']))
+    op.execute("""
+               UPDATE package SET current_priority = static_priority
+                   + manual_priority + dependency_priority + time_priority
+                   + failed_priority
+               """)
+    op.alter_column('package', 'current_priority', nullable=False)
+    op.create_index('ix_package_current_priority', 'package',
+                    ['current_priority'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_package_current_priority', table_name='package')
+    op.alter_column('package', 'current_priority', nullable=True)
+    for component in 'dependency', 'time', 'failed':
+        op.drop_column('package', component + '_priority')
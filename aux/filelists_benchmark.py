@@ -0,0 +1,111 @@
+#!/usr/bin/python
+"""
+Compares resolution with filelists loaded upfront and on demand.
+
+Usage: filelists_benchmark.py REPO_DIR SRPM_REPO_DIR GROUP_PACKAGE...
+
+REPO_DIR contains downloaded Koji repo with subdirectory for each arch,
+SRPM_REPO_DIR is a local repo with SRPMs, such as SRPM cache view.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import logging
+import librepo
+import hawkey
+import tempfile
+import contextlib
+import multiprocessing
+
+from koschei import util
+from koschei.resolver import GenerateRepoTask
+from koschei.sack_cache import SackCache, get_rss
+
+
+def load_repo(path):
+    h = librepo.Handle()
+    h.local = True
+    h.repotype = librepo.LR_YUMREPO
+    h.urls = [path]
+    h.yumdlist = ['primary', 'filelists', 'group']
+    return h.perform(librepo.Result())
+
+
+class LocalRepos(object):
+    def __init__(self, repo_dir, cache_dir):
+        self._repo_dir = repo_dir
+        self._cache_dir = cache_dir
+
+    def get_repos(self, repo_id):
+        return {arch: load_repo(os.path.join(self._repo_dir, arch))
+                for arch in os.listdir(self._repo_dir)
+                if os.path.isdir(os.path.join(self._repo_dir, arch,
+                                              'repodata'))}
+
+    @contextlib.contextmanager
+    def use_repos(self, repo_id):
+        yield self.get_repos(repo_id)
+
+    def get_cache_dir(self, repo_id):
+        return self._cache_dir
+
+
+def run(args):
+    repo_dir, srpm_dir, group, on_demand = args
+    util.config['dependency']['filelists_on_demand'] = on_demand
+    repos = LocalRepos(repo_dir, tempfile.mkdtemp())
+    task = GenerateRepoTask(log=logging.getLogger('benchmark'), db=None,
+                            koji_session=None, srpm_cache=None,
+                            repo_cache=repos, sack_cache=SackCache(repos),
+                            backend=None)
+    task.group = group
+    rss = get_rss()
+    start = time.time()
+    task.prepare_sack(0, load_repo(srpm_dir))
+    load_time = time.time() - start
+    results = {}
+    for srpm in hawkey.Query(task.sack).filter(arch='src'):
+        resolved, problems, deps = task.resolve_requires(srpm)
+        results[srpm.name] = (resolved, problems,
+                              deps and sorted((dep.name, dep.epoch,
+                                               dep.version, dep.release,
+                                               dep.arch, dep.distance)
+                                              for dep in deps))
+    return dict(load_time=load_time, total_time=time.time() - start,
+                rss=(get_rss() - rss) / 1024 / 1024,
+                filelists=len(task.filelists_names), results=results)
+
+
+def main():
+    if len(sys.argv) < 4:
+        sys.exit(__doc__)
+    repo_dir, srpm_dir = sys.argv[1:3]
+    group = sys.argv[3:]
+    stats = {}
+    for on_demand in False, True:
+        # separate process for each mode, so that memory isn't shared
+        pool = multiprocessing.Pool(1)
+        stats[on_demand] = pool.apply(run, [(repo_dir, srpm_dir, group,
+                                             on_demand)])
+        pool.close()
+        pool.join()
+    for on_demand, mode in (False, "full"), (True, "on demand"):
+        mode_stats = stats[on_demand]
+        print("{:10} sack load {:7.2f} s, total {:7.2f} s, RSS {:6d} MiB, "
+              "{} packages needed filelists"
+              .format(mode, mode_stats['load_time'], mode_stats['total_time'],
+                      mode_stats['rss'], mode_stats['filelists']))
+    full, on_demand = stats[False]['results'], stats[True]['results']
+    differing = sorted(name for name in full
+                       if full[name] != on_demand.get(name))
+    print("{} of {} packages resolved differently{}"
+          .format(len(differing), len(full),
+                  ': ' + ', '.join(differing) if differing else ''))
+    sys.exit(1 if differing else 0)
+
+
+if __name__ == '__main__':
+    main()
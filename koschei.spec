@@ -39,7 +39,7 @@ Requires:       koji
 Requires:       fedmsg
 Requires:       python-psycopg2
 Requires:       createrepo_c
-Requires:       curl
+Requires:       python-requests
 Requires:       python-jinja2
 Requires:       python-hawkey
 Requires:       python-alembic
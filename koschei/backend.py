@@ -17,10 +17,13 @@
 # Author: Michael Simacek <msimacek@redhat.com>
 
 import json
+import math
 import koji
 
 from datetime import datetime
+from sqlalchemy import func, bindparam
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.functions import coalesce
 
 from . import util
 from .models import (Build, DependencyChange, KojiTask, Package,
@@ -48,6 +51,20 @@ def check_package_state(package, prev_pkg_state):
         event.dispatch()
 
 
+def get_time_priority(hours):
+    """
+    Returns priority of a package whose last build started given number of
+    hours ago. It grows logarithmically and reaches build threshold after t1
+    hours.
+    """
+    priority_conf = util.config['priorities']
+    t0 = priority_conf['t0']
+    t1 = priority_conf['t1']
+    a = priority_conf['build_threshold'] / (math.log10(t1) - math.log10(t0))
+    b = -a * math.log10(t0)
+    return max(a * math.log10(max(hours, 0) + 0.00001) + b, -30)
+
+
 class Backend(object):
 
     def __init__(self, log, db, koji_session):
@@ -75,6 +92,7 @@ class Backend(object):
             self.db.add(build)
             self.db.flush()
             self.flush_depchanges(build)
+            self.update_build_priorities([package.id])
         else:
             package.ignored = True
 
@@ -83,6 +101,96 @@ class Backend(object):
                .filter_by(package_id=build.package_id)\
                .filter_by(applied_in_id=None)\
                .delete()
+        self.update_dependency_priorities([build.package_id])
+
+    def update_priority_component(self, component, priorities,
+                                  package_ids=None):
+        """
+        Sets priority component of packages with given ids (all packages if
+        None) to values from priorities dictionary mapping package ids to
+        values, packages missing from it get 0. current_priority is adjusted
+        by the difference and only rows whose value changes are written.
+        """
+        column = getattr(Package, component)
+        query = self.db.query(Package.id, column)
+        if package_ids is not None:
+            if not package_ids:
+                return
+            query = query.filter(Package.id.in_(package_ids))
+        changed = [dict(pkg_id=pkg_id, value=priorities.get(pkg_id, 0))
+                   for pkg_id, value in query
+                   if value != priorities.get(pkg_id, 0)]
+        if changed:
+            # pylint: disable=E1101
+            table = Package.__table__
+            value = bindparam('value')
+            self.db.execute(table.update()
+                            .where(table.c.id == bindparam('pkg_id'))
+                            .values({component: value,
+                                     'current_priority':
+                                     table.c.current_priority -
+                                     table.c[component] + value}),
+                            changed)
+            self.db.expire_all()
+
+    def update_dependency_priorities(self, package_ids=None):
+        """
+        Updates priority of packages given by unapplied dependency changes,
+        each change contributes more the closer the dependency is.
+        """
+        update_weight = util.config['priorities']['package_update']
+        distance = coalesce(DependencyChange.distance, 8)
+        query = self.db.query(DependencyChange.package_id,
+                              func.sum(update_weight / distance))\
+                       .filter_by(applied_in_id=None)\
+                       .group_by(DependencyChange.package_id)
+        if package_ids is not None:
+            query = query.filter(DependencyChange.package_id
+                                 .in_(package_ids))
+        priorities = {pkg_id: int(priority) for pkg_id, priority in query}
+        self.update_priority_component('dependency_priority', priorities,
+                                       package_ids)
+
+    def update_time_priorities(self, package_ids=None):
+        """
+        Updates priority of packages given by time since their last build
+        started. As it grows with time, it needs to be refreshed
+        periodically.
+        """
+        query = self.db.query(Build.package_id, func.max(Build.started))\
+                       .group_by(Build.package_id)
+        if package_ids is not None:
+            query = query.filter(Build.package_id.in_(package_ids))
+        now = datetime.now()
+        priorities = {pkg_id: int(round(get_time_priority(
+                          (now - started).total_seconds() / 3600)))
+                      for pkg_id, started in query if started}
+        self.update_priority_component('time_priority', priorities,
+                                       package_ids)
+
+    def update_failed_priorities(self, package_ids):
+        """
+        Updates priority of packages whose last build failed while the
+        previous one didn't.
+        """
+        failed_priority = util.config['priorities']['failed_build_priority']
+        priorities = {}
+        for package_id in package_ids:
+            states = [state for [state] in
+                      self.db.query(Build.state)
+                             .filter_by(package_id=package_id)
+                             .order_by(Build.id.desc()).limit(2)]
+            if (len(states) == 2 and states[0] == Build.FAILED and
+                    states[1] != Build.FAILED):
+                priorities[package_id] = failed_priority
+        self.update_priority_component('failed_priority', priorities,
+                                       package_ids)
+
+    def update_build_priorities(self, package_ids):
+        """ Updates priority components that depend on package's builds """
+        self.db.flush()
+        self.update_time_priorities(package_ids)
+        self.update_failed_priorities(package_ids)
 
     def get_newer_build_if_exists(self, package):
         [info] = self.koji_session.listTagged(util.source_tag, latest=True,
@@ -115,6 +223,7 @@ class Backend(object):
             self.db.flush()
             self._build_completed(build)
             self.flush_depchanges(build)
+            self.update_build_priorities([package.id])
             self.log.info('Registering real build for {}, task_id {}.'
                           .format(package, build.task_id))
             return build
@@ -137,7 +246,9 @@ class Backend(object):
             if state == Build.CANCELED:
                 self.log.info('Deleting build {0} because it was canceled'
                               .format(build))
+                package_id = build.package_id
                 self.db.delete(build)
+                self.update_build_priorities([package_id])
                 self.db.commit()
                 return
             assert state in (Build.COMPLETE, Build.FAILED)
@@ -151,6 +262,7 @@ class Backend(object):
                              .with_lockmode('update').one()
             prev_state = package.msg_state_string
             build.state = state
+            self.update_build_priorities([package.id])
             # unlock
             self.db.commit()
             new_state = package.msg_state_string
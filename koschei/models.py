@@ -22,7 +22,8 @@ from sqlalchemy import (create_engine, Column, Integer, String, Boolean,
                         ForeignKey, DateTime, Index, DDL)
 from sqlalchemy.sql.expression import extract, func, select, false, join
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, column_property, mapper
+from sqlalchemy.orm import (sessionmaker, relationship, column_property, mapper,
+                            attributes)
 from sqlalchemy.engine.url import URL
 from sqlalchemy.event import listen
 from datetime import datetime
@@ -45,6 +46,63 @@ def external_id():
     raise AssertionError("ID needs to be supplied")
 
 
+def _copy_value(value):
+    if value is None:
+        return r'\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t')\
+                .replace('\n', '\\n').replace('\r', '\\r')
+
+
+class _CopyStream(object):
+    """ File-like object reading COPY text format lines from an iterator """
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def bulk_insert(db, table, rows):
+    """
+    Inserts rows given as dictionaries (or generator of them) into table
+    within db session's transaction. On PostgreSQL, rows are streamed using
+    COPY FROM STDIN, other databases fall back to executemany. Primary keys
+    are always generated by the database.
+    """
+    if db.bind.dialect.name != 'postgresql':
+        rows = list(rows)
+        if rows:
+            db.execute(table.insert(), rows)
+        return
+    columns = [c.name for c in table.c if not c.primary_key]
+    lines = ('\t'.join(_copy_value(row.get(column)) for column in columns)
+             + '\n' for row in rows)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN'
+                           .format(table.name, ', '.join(columns)),
+                           _CopyStream(lines))
+    finally:
+        cursor.close()
+
+
 class User(Base):
     __tablename__ = 'user'
 
@@ -62,12 +120,24 @@ class Package(Base):
     name = Column(String, nullable=False, unique=True)
     static_priority = Column(Integer, nullable=False, default=0)
     manual_priority = Column(Integer, nullable=False, default=0)
+    # computed priority components, updated by backend when their inputs
+    # change
+    dependency_priority = Column(Integer, nullable=False, default=0,
+                                 server_default='0')
+    time_priority = Column(Integer, nullable=False, default=0,
+                           server_default='0')
+    failed_priority = Column(Integer, nullable=False, default=0,
+                             server_default='0')
     added = Column(DateTime, nullable=False, default=datetime.now)
 
     arch_override = Column(String)
 
-    # cached value, populated by scheduler
-    current_priority = Column(Integer)
+    # sum of priority components, kept up to date whenever they change
+    current_priority = Column(Integer, nullable=False, index=True)
+
+    PRIORITY_COMPONENTS = ('static_priority', 'manual_priority',
+                           'dependency_priority', 'time_priority',
+                           'failed_priority')
 
     # denormalized field, updated by trigger on inser/update (no delete)
     last_complete_build_id = \
@@ -266,6 +336,30 @@ class AdminNotice(Base):
     key = Column(String, primary_key=True)
     content = Column(String, nullable=False)
 
+
+# Priority
+
+def _init_current_priority(_mapper, _connection, package):
+    package.current_priority = sum(getattr(package, name) or 0
+                                   for name in Package.PRIORITY_COMPONENTS)
+
+
+def _update_current_priority(_mapper, _connection, package):
+    # changes are applied as differences against the values in the database,
+    # so concurrent updates of other components are not overwritten
+    current_priority = None
+    for name in Package.PRIORITY_COMPONENTS:
+        if attributes.get_history(package, name).has_changes():
+            if current_priority is None:
+                current_priority = Package.current_priority
+            current_priority = (current_priority - getattr(Package, name) +
+                                getattr(package, name))
+    if current_priority is not None:
+        package.current_priority = current_priority
+
+listen(Package, 'before_insert', _init_current_priority)
+listen(Package, 'before_update', _update_current_priority)
+
 # Triggers
 
 trigger = DDL("""
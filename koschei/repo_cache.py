@@ -17,10 +17,17 @@
 # Author: Michael Simacek <msimacek@redhat.com>
 
 import os
+import errno
+import fcntl
 import librepo
 import shutil
 import logging
 import pickle
+import threading
+import contextlib
+
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 from koschei import util
 
@@ -28,8 +35,34 @@ log = logging.getLogger('koschei.repo_cache')
 
 REPO_404 = 19
 
+TMP_SUFFIX = '.tmp'
+QUARANTINE_SUFFIX = '.corrupt'
+# evicted repos are renamed to temporary directory before removal
+EVICTED_SUFFIX = '.evicted'
+
+# metadata files shared by repos, named by their checksums
+OBJECTS_DIR = 'objects'
+
+# filelists are needed even with dependency.filelists_on_demand, as the
+# fallback loads them from the same repo, and they're stored only once as
+# long as they don't change between repos
+METADATA = ['primary', 'filelists', 'group']
+
+# lock files and LRU journal shared by all processes using the cache
+LOCK_DIR = '.locks'
+JOURNAL_FILE = 'lru.journal'
+
 
 class RepoCache(object):
+    """
+    Cache of Koji repos on disk, which may be shared by multiple processes.
+
+    Each process holds a shared lock of every repo it has loaded, repos
+    locked by any process are never evicted. Repos are downloaded under
+    exclusive per-repo download lock into temporary directory, which is
+    renamed into place when complete. Uses of repos are appended to a
+    journal, which determines LRU order of eviction across processes.
+    """
 
     def __init__(self, repo_dir=util.config['directories']['repodata'],
                  max_repos=util.config['dependency']['repo_cache_items'],
@@ -38,73 +71,422 @@ class RepoCache(object):
         assert max_repos > 2
         self._max_repos = max_repos
         self._koji_repos = koji_repos
-        self._lru = {}
-        self._index = 0
+        # maps repo_id to pair of (librepo results by arch, file holding
+        # shared lock of the repo) for repos loaded by this process
         self._cache = {}
+        # guards _cache, _prefetching and _in_use, which are shared with
+        # prefetching threads
+        self._lock = threading.Lock()
+        # maps repo_id to thread downloading it in background
+        self._prefetching = {}
+        # maps repo_id to number of use_repos contexts using it, such repos
+        # are never evicted
+        self._in_use = defaultdict(int)
 
-        existing_repos = []
-        for repo in os.listdir(self._repo_dir):
-            if repo.isdigit():
-                existing_repos.append(int(repo))
-        existing_repos.sort()
-        for repo in existing_repos:
-            self._load_from_disk(repo)
+        # repos are loaded lazily on first use
+        for name in os.listdir(self._repo_dir):
+            if name.isdigit():
+                repo_id = int(name)
+                if not self._is_complete(repo_id):
+                    # repos used by other processes are left alone
+                    lock = self._try_lock(name, fcntl.LOCK_EX)
+                    if lock:
+                        if not self._is_complete(repo_id):
+                            self._quarantine(repo_id)
+                        lock.close()
+            elif name.endswith(TMP_SUFFIX):
+                # leftover of interrupted download or eviction, unless other
+                # process is still working on it
+                repo_id = name[1:].split('.')[0]
+                if name.endswith(EVICTED_SUFFIX + TMP_SUFFIX):
+                    lock = self._try_lock(repo_id, fcntl.LOCK_EX)
+                else:
+                    lock = self._try_lock('{}.download'.format(repo_id),
+                                          fcntl.LOCK_EX)
+                if lock:
+                    shutil.rmtree(os.path.join(self._repo_dir, name),
+                                  ignore_errors=True)
+                    lock.close()
+        self._evict()
+
+    def _open_lock(self, name):
+        lock_dir = os.path.join(self._repo_dir, LOCK_DIR)
+        if not os.path.exists(lock_dir):
+            try:
+                os.mkdir(lock_dir)
+            except OSError:
+                # created by other process
+                pass
+        return open(os.path.join(lock_dir, name + '.lock'), 'a')
+
+    def _lock_file(self, name, operation):
+        """ Returns open lock file with acquired flock """
+        lock = self._open_lock(name)
+        try:
+            fcntl.flock(lock, operation)
+        except:
+            lock.close()
+            raise
+        return lock
+
+    def _try_lock(self, name, operation):
+        """
+        Returns open lock file with acquired flock or None if the lock is
+        held by someone else.
+        """
+        try:
+            return self._lock_file(name, operation | fcntl.LOCK_NB)
+        except IOError:
+            return None
+
+    @contextlib.contextmanager
+    def _locked(self, name, operation):
+        lock = self._lock_file(name, operation)
+        try:
+            yield
+        finally:
+            lock.close()
+
+    def _journal_path(self):
+        return os.path.join(self._repo_dir, LOCK_DIR, JOURNAL_FILE)
+
+    def _record_use(self, repo_id):
+        # appends are atomic, compaction replaces the file under exclusive lock
+        with self._locked('journal', fcntl.LOCK_SH):
+            with open(self._journal_path(), 'a') as journal:
+                journal.write('{}\n'.format(repo_id))
+
+    def _read_journal(self, repo_ids):
+        """
+        Returns dictionary mapping given repo_ids to positions of their last
+        uses in the journal, repos that weren't used are left out. Compacts
+        the journal when it grows too long.
+        """
+        with self._locked('journal', fcntl.LOCK_EX):
+            try:
+                with open(self._journal_path()) as journal:
+                    uses = journal.read().split()
+            except IOError:
+                return {}
+            positions = {int(repo_id): i for i, repo_id in enumerate(uses)}
+            positions = {repo_id: i for repo_id, i in positions.iteritems()
+                         if repo_id in repo_ids}
+            if len(uses) > 10 * self._max_repos:
+                tmp_path = self._journal_path() + TMP_SUFFIX
+                with open(tmp_path, 'w') as journal:
+                    for repo_id in sorted(positions, key=positions.get):
+                        journal.write('{}\n'.format(repo_id))
+                os.rename(tmp_path, self._journal_path())
+            return positions
 
     def _get_repo_dir(self, repo_id, arch=None):
         if arch:
             return os.path.join(self._repo_dir, str(repo_id), arch)
         return os.path.join(self._repo_dir, str(repo_id))
 
+    def _get_repomd_path(self, repo_id, arch):
+        return os.path.join(self._get_repo_dir(repo_id, arch), 'repodata',
+                            'repomd.xml')
+
+    def _is_complete(self, repo_id):
+        return all(os.path.isfile(self._get_repomd_path(repo_id, arch))
+                   for arch in self._koji_repos.keys())
+
+    def _get_tmp_dir(self, repo_id, suffix=''):
+        return os.path.join(self._repo_dir, '.{}.{}{}{}'.format(repo_id,
+                                                               os.getpid(),
+                                                               suffix,
+                                                               TMP_SUFFIX))
+
+    def get_cache_dir(self, repo_id):
+        """
+        Returns directory for libsolv cache files of given repo. It's placed
+        within the repo directory, so it's removed together with the repo.
+        """
+        return os.path.join(self._get_repo_dir(repo_id), 'cache')
+
+    def _get_object_path(self, checksum):
+        return os.path.join(self._repo_dir, OBJECTS_DIR, checksum)
+
+    def _store_object(self, path, checksum):
+        # called concurrently from threads downloading different arches
+        util.mkdir_if_absent(os.path.join(self._repo_dir, OBJECTS_DIR))
+        try:
+            os.link(path, self._get_object_path(checksum))
+        except OSError:
+            # already stored by concurrent download
+            pass
+
+    def _collect_garbage(self):
+        """
+        Removes metadata files from the store that are not linked from any
+        repo anymore.
+        """
+        objects_dir = os.path.join(self._repo_dir, OBJECTS_DIR)
+        if os.path.exists(objects_dir):
+            for checksum in os.listdir(objects_dir):
+                path = self._get_object_path(checksum)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.unlink(path)
+                except OSError as e:
+                    # removed by collection in other process
+                    if e.errno != errno.ENOENT:
+                        raise
+
+    def _download_arch(self, download):
+        destdir, url = download
+        h = librepo.Handle()
+        os.makedirs(destdir)
+        h.destdir = destdir
+        h.repotype = librepo.LR_YUMREPO
+        h.urls = [url]
+        # only repomd.xml first, files that are already in the store are
+        # linked from there instead of downloading them
+        h.yumdlist = []
+        log.info("Downloading repo from {url}".format(url=url))
+        result = h.perform(librepo.Result())
+        records = {name: record for name, record
+                   in result.yum_repomd.items() if name in METADATA}
+        missing = []
+        for name, record in records.items():
+            try:
+                os.link(self._get_object_path(record['checksum']),
+                        os.path.join(destdir, record['location_href']))
+            except OSError:
+                missing.append(name)
+        if missing:
+            h.update = True
+            h.yumdlist = missing
+            h.perform(result)
+            for name in missing:
+                record = records[name]
+                self._store_object(os.path.join(destdir,
+                                                record['location_href']),
+                                   record['checksum'])
+
     def _download_repo(self, repo_id):
-        repos = {}
+        """
+        Downloads repos of all arches concurrently into a temporary directory,
+        which is moved into place only if all of them succeed, so an
+        incomplete repo is never loaded. Returns None if the repo is not
+        available.
+        """
+        tmp_dir = self._get_tmp_dir(repo_id)
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        downloads = []
+        for arch, repo_url in self._koji_repos.items():
+            assert '{repo_id}' in repo_url
+            downloads.append((os.path.join(tmp_dir, arch),
+                              repo_url.format(repo_id=repo_id)))
+        pool = ThreadPool(len(downloads))
+        result = pool.map_async(self._download_arch, downloads)
+        pool.close()
+        pool.join()
         try:
-            for arch, repo_url in self._koji_repos.items():
-                h = librepo.Handle()
-                destdir = self._get_repo_dir(repo_id, arch)
-                if os.path.exists(destdir):
-                    shutil.rmtree(destdir)
-                os.makedirs(destdir)
-                h.destdir = destdir
-                h.repotype = librepo.LR_YUMREPO
-                assert '{repo_id}' in repo_url
-                url = repo_url.format(repo_id=repo_id)
-                h.urls = [url]
-                h.yumdlist = ['primary', 'filelists', 'group']
-                log.info("Downloading {arch} repo from {url}".format(arch=arch,
-                                                                     url=url))
-                result = h.perform(librepo.Result())
-                repos[arch] = result
-            self._add_repo(repo_id, repos)
-            return repos
-        except librepo.LibrepoException as e:
-            if e.args[0] == REPO_404:
+            result.get()
+        except Exception as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if isinstance(e, librepo.LibrepoException) and \
+                    e.args[0] == REPO_404:
                 log.info("Repo id={} not available, skipping".format(repo_id))
                 return None
             raise
+        os.rename(tmp_dir, self._get_repo_dir(repo_id))
+        return True
 
     def _load_from_disk(self, repo_id):
+        """
+        Loads repo from disk, verifying checksums of its metadata. Returns
+        None if the repo is incomplete or corrupt.
+        """
         try:
             repos = {}
             for arch in self._koji_repos.keys():
                 h = librepo.Handle()
                 h.local = True
+                h.checksum = True
                 h.repotype = librepo.LR_YUMREPO
                 h.urls = [self._get_repo_dir(repo_id, arch)]
-                h.yumdlist = ['primary', 'filelists', 'group']
+                h.yumdlist = METADATA
                 repos[arch] = h.perform(librepo.Result())
-            self._add_repo(repo_id, repos)
             return repos
-        except (librepo.LibrepoException, IOError):
-            pass
+        except (librepo.LibrepoException, IOError) as e:
+            log.warn("Cannot load repo {} from disk: {}".format(repo_id, e))
+
+    def _load_existing(self, repo_id, lock):
+        """
+        Loads repo from disk if it's there. Corrupt repo is quarantined,
+        unless it's used by other processes. Lock is this process's shared
+        lock of the repo.
+        """
+        if os.path.exists(self._get_repo_dir(repo_id)):
+            repos = self._load_from_disk(repo_id)
+            if repos:
+                return repos
+            try:
+                # upgrade of the shared lock, so that the repo isn't moved
+                # away from other processes
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                log.warn("Repo {} is corrupt, but it's used by other process"
+                         .format(repo_id))
+            else:
+                self._quarantine(repo_id)
+            finally:
+                # failed upgrade may have released the lock as well
+                fcntl.flock(lock, fcntl.LOCK_SH)
+
+    def _quarantine(self, repo_id):
+        """
+        Moves corrupt repo out of the way, so it can be downloaded again.
+        Only the last quarantined copy of each repo is kept for inspection.
+        Exclusive lock of the repo must be held.
+        """
+        repo_dir = self._get_repo_dir(repo_id)
+        if not os.path.exists(repo_dir):
+            return
+        quarantine_dir = os.path.join(self._repo_dir, '.{}{}'
+                                      .format(repo_id, QUARANTINE_SUFFIX))
+        if os.path.exists(quarantine_dir):
+            shutil.rmtree(quarantine_dir)
+        os.rename(repo_dir, quarantine_dir)
+        log.warn("Repo {} is corrupt, moved to {}".format(repo_id,
+                                                         quarantine_dir))
+
+    def _evict(self, keep=None):
+        """
+        Removes least recently used repos until there are at most max_repos
+        of them on disk and collects garbage in the store. Runs under
+        exclusive evict lock, so that evictions in other processes or
+        prefetching threads don't remove the same files concurrently.
+        """
+        with self._locked('evict', fcntl.LOCK_EX):
+            repo_ids = [int(name) for name in os.listdir(self._repo_dir)
+                        if name.isdigit()]
+            excess = len(repo_ids) - self._max_repos
+            if excess > 0:
+                self._remove_lru(repo_ids, excess, keep)
+            self._collect_garbage()
 
-    def _add_repo(self, repo_id, repos):
-        while len(self._cache) + 1 > self._max_repos:
-            victim = sorted(self._lru.items(), key=lambda (k, v): (v, k))[0][0]
-            del self._cache[victim]
-            del self._lru[victim]
-            shutil.rmtree(self._get_repo_dir(victim))
-        self._cache[repo_id] = repos
-        self._lru[repo_id] = self._index
+    def _remove_lru(self, repo_ids, excess, keep):
+        """
+        Removes given number of least recently used repos. Repos locked by
+        other processes and repos used by any thread of this process are
+        skipped.
+        """
+        positions = self._read_journal(repo_ids)
+        for victim in sorted(repo_ids, key=lambda r: (positions.get(r, -1), r)):
+            if excess <= 0:
+                break
+            if victim == keep:
+                continue
+            with self._lock:
+                if self._in_use.get(victim):
+                    continue
+                entry = self._cache.pop(victim, None)
+            if entry:
+                # our own shared lock would prevent the removal
+                entry[1].close()
+            lock = self._try_lock(str(victim), fcntl.LOCK_EX)
+            if lock:
+                repo_dir = self._get_repo_dir(victim)
+                if os.path.exists(repo_dir):
+                    # other processes never see partially removed repo
+                    evicted_dir = self._get_tmp_dir(victim, EVICTED_SUFFIX)
+                    if os.path.exists(evicted_dir):
+                        shutil.rmtree(evicted_dir)
+                    os.rename(repo_dir, evicted_dir)
+                    # removes libsolv cache as well
+                    shutil.rmtree(evicted_dir)
+                lock.close()
+                excess -= 1
+
+    def _acquire_repo(self, repo_id):
+        """
+        Loads repo from disk or downloads it if it's not there. The repo stays
+        locked against eviction by other processes while it's in this
+        process's cache.
+        """
+        lock = self._lock_file(str(repo_id), fcntl.LOCK_SH)
+        try:
+            repos = self._load_existing(repo_id, lock)
+            if not repos:
+                with self._locked('{}.download'.format(repo_id),
+                                  fcntl.LOCK_EX):
+                    # other process may have downloaded it meanwhile
+                    repos = self._load_existing(repo_id, lock)
+                    # corrupt repo used by other process cannot be replaced
+                    if (not repos and
+                            not os.path.exists(self._get_repo_dir(repo_id)) and
+                            self._download_repo(repo_id)):
+                        repos = self._load_existing(repo_id, lock)
+        except:
+            lock.close()
+            raise
+        if not repos:
+            lock.close()
+            return None
+        with self._lock:
+            self._cache[repo_id] = repos, lock
+        self._evict(keep=repo_id)
+        return repos
+
+    def _prefetch(self, repo_id):
+        try:
+            if self._acquire_repo(repo_id):
+                self._record_use(repo_id)
+        except Exception:
+            # get_repos will try again and report the error
+            log.exception("Prefetching repo {} failed".format(repo_id))
+        finally:
+            with self._lock:
+                del self._prefetching[repo_id]
+
+    def prefetch(self, repo_id):
+        """
+        Starts downloading given repo in background, unless it's already
+        cached or being downloaded. At most max_repos - 1 repos are prefetched
+        at a time, so that they don't evict each other before they are used.
+        """
+        with self._lock:
+            if (repo_id in self._cache or repo_id in self._prefetching or
+                    len(self._prefetching) >= self._max_repos - 1):
+                return
+            thread = threading.Thread(target=self._prefetch, args=(repo_id,),
+                                      name='prefetch-{}'.format(repo_id))
+            thread.daemon = True
+            self._prefetching[repo_id] = thread
+            thread.start()
+
+    def join_prefetching(self):
+        """
+        Waits until all repos being prefetched are downloaded. Needs to be
+        called before forking, children would inherit locks held by the
+        prefetching threads.
+        """
+        with self._lock:
+            threads = self._prefetching.values()
+        for thread in threads:
+            thread.join()
+
+    @contextlib.contextmanager
+    def use_repos(self, repo_id):
+        """
+        Context manager providing the same as get_repos. The repo is not
+        evicted by this process, including prefetching threads, while it's
+        in use.
+        """
+        with self._lock:
+            self._in_use[repo_id] += 1
+        try:
+            yield self.get_repos(repo_id)
+        finally:
+            with self._lock:
+                self._in_use[repo_id] -= 1
+                if not self._in_use[repo_id]:
+                    del self._in_use[repo_id]
 
     def get_repo(self, repo_id, arch):
         repos = self.get_repos(repo_id)
@@ -112,10 +494,13 @@ class RepoCache(object):
             return repos.get(arch)
 
     def get_repos(self, repo_id):
-        repo = self._cache.get(repo_id)
-        if not repo:
-            repo = self._download_repo(repo_id)
-        if repo:
-            self._index += 1
-            self._lru[repo_id] = self._index
-            return repo
+        with self._lock:
+            thread = self._prefetching.get(repo_id)
+        if thread:
+            thread.join()
+        with self._lock:
+            entry = self._cache.get(repo_id)
+        repos = entry[0] if entry else self._acquire_repo(repo_id)
+        if repos:
+            self._record_use(repo_id)
+            return repos
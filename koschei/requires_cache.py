@@ -0,0 +1,249 @@
+# Copyright (C) 2015  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import koji
+import hawkey
+import logging
+import os
+import rpm
+import sqlite3
+
+from collections import defaultdict
+
+from koschei import util
+from koschei.util import itercall
+from koschei.srpm_cache import get_outdated, get_srpm_nvra
+
+log = logging.getLogger('koschei.requires_cache')
+
+CACHE_FILE = 'requires.sqlite'
+
+SENSE_SYMBOLS = ((rpm.RPMSENSE_LESS, '<'), (rpm.RPMSENSE_GREATER, '>'),
+                 (rpm.RPMSENSE_EQUAL, '='))
+
+
+def format_reldep(dep):
+    """ Formats dependency returned by Koji's getRPMDeps as reldep string """
+    op = ''.join(symbol for flag, symbol in SENSE_SYMBOLS
+                 if dep['flags'] & flag)
+    if op and dep['version']:
+        return '{} {} {}'.format(dep['name'], op, dep['version'])
+    return dep['name']
+
+
+class SourcePackage(object):
+    """
+    Source package whose requires were obtained from Koji. Substitutes hawkey
+    package of SRPM in resolution, requires are converted to reldeps of given
+    sack on first access. Requires that are unknown to the sack, such as
+    unsatisfiable ones or file paths not listed in primary, cannot be
+    converted and are kept as strings, which have no providers.
+    """
+
+    def __init__(self, sack, name, epoch, version, release, requires):
+        self.name = name
+        self.epoch = epoch or 0
+        self.version = version
+        self.release = release
+        self._sack = sack
+        self._requires = requires
+        self._reldeps = None
+
+    @property
+    def evr(self):
+        evr = '{}-{}'.format(self.version, self.release)
+        return '{}:{}'.format(self.epoch, evr) if self.epoch else evr
+
+    @property
+    def requires(self):
+        if self._reldeps is None:
+            self._reldeps = []
+            for reldep in self._requires.splitlines():
+                try:
+                    self._reldeps.append(hawkey.Reldep(self._sack, reldep))
+                except hawkey.ValueException:
+                    self._reldeps.append(reldep)
+        return self._reldeps
+
+    def __str__(self):
+        return '{}-{}.src'.format(self.name, self.evr)
+
+
+class RequiresIndex(object):
+    """
+    Index of source packages from RequiresCache, same interface as SRPMIndex.
+    The index follows changes of the cache, so it can be kept together with
+    its sack for as long as the sack is.
+    """
+
+    def __init__(self, sack, cache):
+        self._sack = sack
+        self._cache = cache
+        self._revision = None
+        self._requires = None
+        self._by_nevr = None
+        self._latest = None
+        self._packages = {}
+        # maps names of required reldeps to names of requiring packages
+        self._requiring = None
+
+    def _refresh(self):
+        if self._revision == self._cache.revision:
+            return
+        requires = self._cache._requires
+        self._requires = requires
+        self._by_nevr = {(name, epoch or 0, version, release):
+                         (name, epoch, version, release)
+                         for name, epoch, version, release in requires}
+        self._latest = {}
+        for nevr in requires:
+            latest = self._latest.get(nevr[0])
+            if latest is None or util.compare_evr(nevr[1:], latest[1:]) > 0:
+                self._latest[nevr[0]] = nevr
+        # requires of a NEVR never change, packages can be reused
+        self._packages = {nevr: pkg for nevr, pkg
+                          in self._packages.iteritems() if nevr in requires}
+        self._requiring = None
+        self._revision = self._cache.revision
+
+    def _get_package(self, nevr):
+        if nevr is None:
+            return None
+        pkg = self._packages.get(nevr)
+        if pkg is None:
+            pkg = SourcePackage(self._sack, *nevr,
+                                requires=self._requires[nevr])
+            self._packages[nevr] = pkg
+        return pkg
+
+    def get(self, name, evr=None):
+        self._refresh()
+        if evr:
+            epoch, version, release = evr
+            return self._get_package(self._by_nevr.get((name, epoch or 0,
+                                                        version, release)))
+        return self._get_package(self._latest.get(name))
+
+    def get_requiring(self, provides):
+        """
+        Returns names of latest source packages that require any of given
+        reldeps. Requires are matched by name only.
+        """
+        self._refresh()
+        if self._requiring is None:
+            self._requiring = defaultdict(set)
+            for name, nevr in self._latest.iteritems():
+                for reldep in self._requires[nevr].splitlines():
+                    self._requiring[reldep.split()[0]].add(name)
+        names = set()
+        for reldep in provides:
+            names.update(self._requiring.get(str(reldep).split()[0], ()))
+        return names
+
+
+class RequiresCache(object):
+    """
+    Alternative to SRPMCache that obtains requires of SRPMs from Koji's RPM
+    dependency metadata instead of downloading SRPM headers. Requires are
+    stored in a local SQLite file keyed by NEVR. There is no SRPM repo,
+    get_repodata returns None and source packages are looked up through
+    index returned by get_index, which is cached together with the sack.
+    """
+
+    def __init__(self, koji_session,
+                 cache_dir=util.config['directories']['srpms'],
+                 keep=util.config['dependency']['srpm_cache_keep']):
+        self._koji_session = koji_session
+        self._keep = keep
+        self._db = sqlite3.connect(os.path.join(cache_dir, CACHE_FILE))
+        self._db.text_factory = str
+        self._db.execute("""CREATE TABLE IF NOT EXISTS requires(
+                                name TEXT NOT NULL,
+                                epoch INTEGER,
+                                version TEXT NOT NULL,
+                                release TEXT NOT NULL,
+                                requires TEXT NOT NULL)""")
+        # maps NEVR to newline separated requires
+        self._requires = {tuple(row[:4]): row[4] for row in
+                          self._db.execute("SELECT * FROM requires")}
+        # incremented on every change of _requires, indexes are rebuilt when
+        # it changes
+        self.revision = 0
+
+    def _fetch(self, srpms):
+        srpms = [srpm for srpm in srpms if srpm and
+                 (srpm['name'], srpm['epoch'], srpm['version'],
+                  srpm['release']) not in self._requires]
+        deps = itercall(self._koji_session, srpms,
+                        lambda k, srpm: k.getRPMDeps(srpm['id'],
+                                                     koji.DEP_REQUIRE))
+        for srpm, srpm_deps in zip(srpms, deps):
+            nevr = (srpm['name'], srpm['epoch'], srpm['version'],
+                    srpm['release'])
+            # rpmlib requires are not satisfiable by packages
+            requires = '\n'.join(format_reldep(dep) for dep in srpm_deps
+                                 if not dep['name'].startswith('rpmlib('))
+            self._requires[nevr] = requires
+            self.revision += 1
+            self._db.execute("INSERT INTO requires VALUES (?,?,?,?,?)",
+                             nevr + (requires,))
+        self._db.commit()
+
+    def get_srpms(self, nevrs):
+        missing = []
+        for nevr in nevrs:
+            if nevr not in self._requires and nevr not in missing:
+                missing.append(nevr)
+        srpms = itercall(self._koji_session, missing,
+                         lambda k, nevr: k.getRPM(get_srpm_nvra(nevr)))
+        self._fetch([srpm for nevr, srpm in zip(missing, srpms)
+                     if srpm and srpm['epoch'] == nevr[1]])
+
+    def get_srpm(self, name, epoch, version, release):
+        nevr = name, epoch, version, release
+        self.get_srpms([nevr])
+        if nevr in self._requires:
+            return nevr
+
+    def get_latest_srpms(self, task_infos):
+        srpms = [srpm for [srpm] in
+                 itercall(self._koji_session, task_infos,
+                          lambda k, i: k.listRPMs(buildID=i['build_id'],
+                                                  arches='src'))]
+        self._fetch(srpms)
+
+    def evict(self, protected=(), tracked=()):
+        """
+        Removes requires of SRPMs that are not among the latest `keep` NEVRs
+        of their package and are not in `protected`. There's no size limit,
+        so `tracked` is not needed.
+        """
+        protected = set(protected)
+        if self._keep:
+            for nevr in get_outdated(self._requires, self._keep):
+                if nevr not in protected:
+                    del self._requires[nevr]
+                    self.revision += 1
+                    self._db.execute("DELETE FROM requires WHERE name = ? "
+                                     "AND epoch IS ? AND version = ? "
+                                     "AND release = ?", nevr)
+        self._db.commit()
+
+    def get_repodata(self, view=None, names=(), nevrs=()):
+        return None
+
+    def get_index(self, sack):
+        return RequiresIndex(sack, self)
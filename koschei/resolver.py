@@ -20,59 +20,308 @@ import os
 import time
 import hawkey
 import itertools
+import multiprocessing
 import dnf.subject
-import dnf.sack
 
+from array import array
+from collections import OrderedDict
+
+from sqlalchemy import func, case
 from sqlalchemy.orm import joinedload
 
 from koschei.models import (Package, Dependency, DependencyChange, Repo,
-                            ResolutionProblem, RepoGenerationRequest, Build)
+                            ResolutionProblem, RepoGenerationRequest, Build,
+                            bulk_insert)
 from koschei import util
 from koschei.service import KojiService
 from koschei.srpm_cache import SRPMCache
+from koschei.requires_cache import RequiresCache
 from koschei.repo_cache import RepoCache
+from koschei.sack_cache import SackCache
 from koschei.backend import check_package_state, Backend
 from koschei.util import itercall
 
 
+def needs_filelists(problems):
+    """
+    Returns whether resolution problems involve file paths, which may be
+    provided by files that are listed only in filelists.
+    """
+    return any(' /' in problem for problem in problems)
+
+
+# dependencies further from the SRPM get no distance
+MAX_DISTANCE = 4
+
+
+class DependencyGraph(object):
+    """
+    Graph of packages in a sack with edges leading from packages to providers
+    of their requires. Packages are represented by integer nodes and edges
+    are stored in arrays. The graph is shared by all packages resolved
+    against the sack and it's expanded lazily, each reldep is looked up and
+    each node is expanded at most once. BFS frontiers of each node, nodes at
+    given distance from it, are memoized too, so searches from different
+    SRPMs reuse them instead of traversing the graph again.
+    """
+
+    def __init__(self, sack):
+        self._sack = sack
+        self._nodes = {}
+        self._packages = []
+        # maps node to array of its successors, None if not expanded yet
+        self._edges = []
+        # maps node to whether it has file requires without providers
+        self._missing = []
+        # maps node to pair of (list of frontiers at distances 1, 2, ...,
+        # list of whether nodes closer than that have missing file requires)
+        self._frontiers = []
+        # maps reldep string to array of nodes providing it
+        self._providers = {}
+        # whether last search encountered file requires without providers
+        self.missing_files = False
+
+    def get_node(self, pkg):
+        node = self._nodes.get(pkg)
+        if node is None:
+            node = len(self._packages)
+            self._nodes[pkg] = node
+            self._packages.append(pkg)
+            self._edges.append(None)
+            self._missing.append(False)
+            self._frontiers.append(([], []))
+        return node
+
+    def _lookup(self, reldeps):
+        """
+        Returns pair of (set of nodes providing given reldeps, whether some
+        of them is a file require without providers)
+        """
+        nodes = set()
+        missing = False
+        for reldep in reldeps:
+            key = str(reldep)
+            providers = self._providers.get(key)
+            if providers is None:
+                providers = array('i')
+                # requires unknown to the sack are kept as strings
+                if not isinstance(reldep, basestring):
+                    query = hawkey.Query(self._sack).filter(provides=reldep)
+                    providers.extend(self.get_node(pkg) for pkg in query)
+                self._providers[key] = providers
+            if not providers and key.startswith('/'):
+                missing = True
+            nodes.update(providers)
+        return nodes, missing
+
+    def get_providers(self, reldeps):
+        nodes, missing = self._lookup(reldeps)
+        self.missing_files |= missing
+        return nodes
+
+    def get_nodes(self, pkgs):
+        return {self.get_node(pkg) for pkg in pkgs}
+
+    def get_name(self, node):
+        return self._packages[node].name
+
+    def _get_successors(self, node):
+        edges = self._edges[node]
+        if edges is None:
+            nodes, missing = self._lookup(self._packages[node].requires)
+            edges = array('i', sorted(nodes))
+            self._edges[node] = edges
+            self._missing[node] = missing
+        return edges
+
+    def _get_frontiers(self, node, depth):
+        """
+        Returns pair of lists of length at least depth. The first contains
+        arrays of nodes at distances 1, 2, ... from given node, the second
+        whether any node closer than the respective distance has file
+        requires without providers. Frontiers are computed from memoized
+        frontiers of successors, as nodes at distance k are those at
+        distance k - 1 from a successor that aren't closer.
+        """
+        frontiers, missing = self._frontiers[node]
+        if len(frontiers) < depth:
+            successors = self._get_successors(node)
+            seen = {node}
+            for frontier in frontiers:
+                seen.update(frontier)
+            while len(frontiers) < depth:
+                distance = len(frontiers) + 1
+                if distance == 1:
+                    frontier = set(successors)
+                    missing.append(self._missing[node])
+                else:
+                    frontier = set()
+                    missed = self._missing[node]
+                    for successor in successors:
+                        succ_frontiers, succ_missing = \
+                            self._get_frontiers(successor, distance - 1)
+                        frontier.update(succ_frontiers[distance - 2])
+                        missed |= succ_missing[distance - 2]
+                    missing.append(missed)
+                frontier -= seen
+                seen.update(frontier)
+                frontiers.append(array('i', sorted(frontier)))
+        return frontiers, missing
+
+    def get_distances(self, reldeps, names):
+        """
+        Performs BFS starting from providers of given reldeps, which are on
+        level 1, up to level MAX_DISTANCE. Returns dictionary mapping given
+        package names to the lowest level on which a package of that name was
+        found. Levels are assembled from memoized frontiers of the starting
+        nodes. The search ends as soon as all names are found.
+        """
+        names = set(names)
+        distances = {}
+        start, self.missing_files = self._lookup(reldeps)
+        frontier = start
+        visited = set(start)
+        level = 1
+        while frontier:
+            for node in frontier:
+                name = self._packages[node].name
+                if name in names and name not in distances:
+                    distances[name] = level
+            if len(distances) == len(names) or level == MAX_DISTANCE:
+                break
+            next_frontier = set()
+            for node in start:
+                frontiers, missing = self._get_frontiers(node, level)
+                next_frontier.update(frontiers[level - 1])
+                self.missing_files |= missing[level - 1]
+            frontier = next_frontier - visited
+            visited.update(frontier)
+            level += 1
+        return distances
+
+
 class AbstractResolverTask(object):
+    # name of SRPM repo view the task resolves against, also distinguishes
+    # its sacks in sack cache
+    srpm_view = None
+
     def __init__(self, log, db, koji_session,
-                 srpm_cache, repo_cache, backend):
+                 srpm_cache, repo_cache, sack_cache, backend,
+                 build_groups=None):
         self.log = log
         self.db = db
         self.koji_session = koji_session
         self.srpm_cache = srpm_cache
         self.repo_cache = repo_cache
+        self.sack_cache = sack_cache
         self.backend = backend
+        # maps repo_id to build group of that repo, shared between tasks
+        self.build_groups = (build_groups if build_groups is not None
+                             else OrderedDict())
         self.problems = []
         self.sack = None
+        self.srpm_index = None
         self.group = None
+        self.group_base = None
+        self.dependency_graph = None
+        self.has_filelists = True
         self.resolved_packages = {}
+        self.filelists_on_demand = \
+            util.config['dependency']['filelists_on_demand']
+        # arguments of last prepare_sack, used to load sack with filelists
+        self.sack_args = None
+        # state of sack with filelists while it's not in use, see
+        # swap_sack_state
+        self.filelists_state = None
+        # names of packages that needed filelists to be resolved
+        self.filelists_names = set()
 
     def get_srpm_pkg(self, name, evr=None):
-        if evr:
-            # pylint: disable=W0633
-            epoch, version, release = evr
-            hawk_pkg = hawkey.Query(self.sack)\
-                             .filter(name=name, epoch=epoch or 0,
-                                     arch='src', version=version,
-                                     release=release)
-        else:
-            hawk_pkg = hawkey.Query(self.sack)\
-                             .filter(name=name, arch='src',
-                                     latest_per_arch=True)
-        if hawk_pkg:
-            return hawk_pkg[0]
+        return self.srpm_index.get(name, evr)
+
+    def get_build_group(self, repo_id):
+        """
+        Returns build group of given repo, read from comps in the repo. Groups
+        of the last repo_cache_items repos are remembered.
+        """
+        group = self.build_groups.get(repo_id)
+        if group is None:
+            # comps must not be evicted while they're read
+            with self.repo_cache.use_repos(repo_id) as repos:
+                group = util.get_build_group(repos)
+            self.build_groups[repo_id] = group
+            while (len(self.build_groups) >
+                   util.config['dependency']['repo_cache_items']):
+                self.build_groups.popitem(last=False)
+        return group
+
+    def get_group_base(self):
+        """
+        Resolves build group alone, once per sack. Returns triple of (packages
+        installed by the group, their nodes in dependency graph, nodes of
+        other packages providing something they require) or an empty tuple if
+        the group cannot be resolved by itself.
+        """
+        if self.group_base is None:
+            self.group_base = ()
+            goal, _ = self.prepare_goal(None)
+            if goal.run():
+                graph = self.get_dependency_graph()
+                installs = goal.list_installs()
+                base = graph.get_nodes(installs)
+                alternatives = graph.get_providers(
+                    [reldep for pkg in installs for reldep in pkg.requires])
+                self.group_base = installs, base, alternatives - base
+        return self.group_base
+
+    def is_base_independent(self, srpm, installs):
+        """
+        Returns whether resolution of given SRPM on top of the group base
+        gave the same result as resolution selecting the build group by
+        names would. That holds when none of the other installed packages
+        provides an alternative to something the base needs and none of the
+        requires of the SRPM and of the other packages can be satisfied by
+        both a base package and a differently named package outside of the
+        base, so the solver had no choice that would depend on the base.
+        """
+        _, base, alternatives = self.group_base
+        graph = self.get_dependency_graph()
+        delta = [pkg for pkg in installs
+                 if pkg.arch != 'src' and graph.get_node(pkg) not in base]
+        if graph.get_nodes(delta) & alternatives:
+            return False
+        base_names = {pkg.name for pkg in self.group_base[0]}
+        for reldep in itertools.chain(srpm.requires, *(pkg.requires
+                                                        for pkg in delta)):
+            providers = graph.get_providers([reldep])
+            if providers & base and any(graph.get_name(node) not in base_names
+                                        for node in providers - base):
+                return False
+        return True
 
-    def prepare_goal(self, srpm):
+    def prepare_goal(self, srpm, group_base=None):
+        """
+        Prepares goal for resolution of given SRPM. The build group is
+        selected by names, or its packages are installed directly if
+        group_base is given.
+        """
         goal = hawkey.Goal(self.sack)
         problems = []
-        for name in self.group:
-            sltr = hawkey.Selector(self.sack).set(name=name)
-            goal.install(select=sltr)
+        if group_base:
+            for pkg in group_base[0]:
+                goal.install(pkg)
+        else:
+            for name in self.group:
+                sltr = hawkey.Selector(self.sack).set(name=name)
+                goal.install(select=sltr)
+        if srpm is None:
+            return goal, problems
         for reldep in srpm.requires:
-            subj = dnf.subject.Subject(str(reldep))
-            sltr = subj.get_best_selector(self.sack)
+            sltr = None
+            # requires unknown to the sack are kept as strings
+            if not isinstance(reldep, basestring):
+                subj = dnf.subject.Subject(str(reldep))
+                sltr = subj.get_best_selector(self.sack)
             # pylint: disable=E1103
             if sltr is None or not sltr.matches():
                 problems.append("No package found for: {}".format(reldep))
@@ -81,62 +330,118 @@ class AbstractResolverTask(object):
         return goal, problems
 
     def store_deps(self, repo_id, package_id, installs):
-        new_deps = []
-        for install in installs or []:
-            if install.arch != 'src':
-                dep = Dependency(repo_id=repo_id, package_id=package_id,
-                                 name=install.name, epoch=install.epoch,
-                                 version=install.version,
-                                 release=install.release,
-                                 arch=install.arch)
-                new_deps.append(dep)
-
-        if new_deps:
-            # pylint: disable=E1101
-            table = Dependency.__table__
-            dicts = [{c.name: getattr(dep, c.name) for c in table.c
-                      if not c.primary_key}
-                     for dep in new_deps]
-            self.db.connection().execute(table.insert(), dicts)
-            self.db.expire_all()
+        rows = (dict(repo_id=repo_id, package_id=package_id,
+                     name=install.name, epoch=install.epoch,
+                     version=install.version, release=install.release,
+                     arch=install.arch)
+                for install in installs or [] if install.arch != 'src')
+        # pylint: disable=E1101
+        bulk_insert(self.db, Dependency.__table__, rows)
+        self.db.expire_all()
+
+    def get_dependency_graph(self):
+        if self.dependency_graph is None:
+            self.dependency_graph = DependencyGraph(self.sack)
+        return self.dependency_graph
 
     def compute_dependency_distances(self, srpm, deps):
-        dep_map = {dep.name: dep for dep in deps}
-        visited = set()
-        level = 1
-        reldeps = srpm.requires
-        while level < 5 and reldeps:
-            pkgs_on_level = set(hawkey.Query(self.sack).filter(provides=reldeps))
-            reldeps = {req for pkg in pkgs_on_level if pkg not in visited
-                       for req in pkg.requires}
-            visited.update(pkgs_on_level)
-            for pkg in pkgs_on_level:
-                dep = dep_map.get(pkg.name)
-                if dep and dep.distance is None:
-                    dep.distance = level
-            level += 1
+        """
+        Sets distances of given deps from the SRPM. Returns False if the
+        search encountered file requires without providers, which may have
+        made the distances longer than they are.
+        """
+        graph = self.get_dependency_graph()
+        distances = graph.get_distances(srpm.requires,
+                                        [dep.name for dep in deps])
+        for dep in deps:
+            dep.distance = distances.get(dep.name)
+        return not graph.missing_files
 
-    def resolve_dependencies(self, package, srpm, repo_id):
-        goal, problems = self.prepare_goal(srpm)
-        if goal is not None:
-            resolved = False
-            if not problems:
+    def resolve_in_sack(self, srpm):
+        """
+        Resolves build dependencies of given SRPM in current sack. Returns
+        triple of (resolved, problems, deps), where deps is a list of
+        transient Dependency objects or None when the resolution failed. If
+        the sack doesn't have filelists and the result may depend on them,
+        returns None.
+        """
+        group_base = self.get_group_base()
+        goal, problems = self.prepare_goal(srpm, group_base)
+        resolved = False
+        if not problems:
+            resolved = goal.run()
+            if group_base and not (resolved and self.is_base_independent(
+                    srpm, goal.list_installs())):
+                # the result may differ from the one with build group
+                # selected by names, solve it from scratch
+                goal, _ = self.prepare_goal(srpm)
                 resolved = goal.run()
-                problems = goal.problems
-            self.resolved_packages[package.id] = resolved
-            if resolved:
-                # pylint: disable=E1101
-                deps = [Dependency(name=pkg.name, epoch=pkg.epoch,
-                                   version=pkg.version, release=pkg.release,
-                                   arch=pkg.arch)
-                        for pkg in goal.list_installs() if pkg.arch != 'src']
-                self.compute_dependency_distances(srpm, deps)
-                return deps
-            else:
-                for problem in sorted(set(problems)):
-                    entry = dict(package_id=package.id,
-                                 problem=problem)
-                    self.problems.append(entry)
+            problems = goal.problems
+        if not resolved:
+            problems = sorted(set(problems))
+            if not self.has_filelists and needs_filelists(problems):
+                return None
+            return False, problems, None
+        # pylint: disable=E1101
+        deps = [Dependency(name=pkg.name, epoch=pkg.epoch,
+                           version=pkg.version, release=pkg.release,
+                           arch=pkg.arch)
+                for pkg in goal.list_installs() if pkg.arch != 'src']
+        if (not self.compute_dependency_distances(srpm, deps) and
+                not self.has_filelists):
+            return None
+        return True, [], deps
+
+    def swap_sack_state(self, state):
+        """
+        Replaces sack and everything derived from it with given state tuple.
+        Returns the previous state.
+        """
+        prev_state = (self.sack, self.srpm_index, self.group_base,
+                      self.dependency_graph, self.has_filelists)
+        (self.sack, self.srpm_index, self.group_base, self.dependency_graph,
+         self.has_filelists) = state
+        return prev_state
+
+    def resolve_with_filelists(self, srpm):
+        """
+        Resolves given SRPM in sack with filelists, which is loaded on first
+        use and kept aside while sack without filelists is in use.
+        """
+        self.filelists_names.add(srpm.name)
+        if self.filelists_state is None:
+            sack, srpm_index = self.load_sack(*self.sack_args, filelists=True)
+            self.filelists_state = sack, srpm_index, None, None, True
+        prev_state = self.swap_sack_state(self.filelists_state)
+        try:
+            srpm = self.get_srpm_pkg(srpm.name, (srpm.epoch, srpm.version,
+                                                 srpm.release))
+            return self.resolve_in_sack(srpm)
+        finally:
+            self.filelists_state = self.swap_sack_state(prev_state)
+
+    def resolve_requires(self, srpm):
+        """
+        Resolves build dependencies of given SRPM, falls back to sack with
+        filelists if the current sack doesn't have them and they may be
+        needed. Returns triple of (resolved, problems, deps), see
+        resolve_in_sack.
+        """
+        result = self.resolve_in_sack(srpm)
+        if result is None:
+            result = self.resolve_with_filelists(srpm)
+        return result
+
+    def record_resolution(self, package_id, resolved, problems):
+        self.resolved_packages[package_id] = resolved
+        for problem in problems:
+            self.problems.append(dict(package_id=package_id,
+                                      problem=problem))
+
+    def resolve_dependencies(self, package, srpm, repo_id):
+        resolved, problems, deps = self.resolve_requires(srpm)
+        self.record_resolution(package.id, resolved, problems)
+        return deps
 
     def get_deps_from_db(self, package_id, repo_id):
         deps = self.db.query(Dependency)\
@@ -175,15 +480,18 @@ class AbstractResolverTask(object):
             changes[dep.name] = change
         return changes.values() if changes else []
 
-    def update_dependency_changes(self, changes, apply_id=None):
+    def update_dependency_changes(self, changes, apply_id=None,
+                                  package_ids=None):
         # pylint: disable=E1101
-        self.db.query(DependencyChange)\
-               .filter_by(applied_in_id=apply_id)\
-               .delete(synchronize_session=False)
-        if changes:
-            self.db.execute(DependencyChange.__table__.insert(),
-                            changes)
+        query = self.db.query(DependencyChange)\
+                       .filter_by(applied_in_id=apply_id)
+        if package_ids is not None:
+            query = query.filter(DependencyChange.package_id.in_(package_ids))
+        query.delete(synchronize_session=False)
+        bulk_insert(self.db, DependencyChange.__table__, changes)
         self.db.expire_all()
+        if apply_id is None:
+            self.backend.update_dependency_priorities(package_ids)
 
     def get_prev_build_for_comparison(self, build):
         return self.db.query(Build)\
@@ -192,16 +500,51 @@ class AbstractResolverTask(object):
                       .filter(Build.deps_resolved == True)\
                       .order_by(Build.id.desc()).first()
 
-    def prepare_sack(self, repo_id):
-        for_arch = util.config['dependency']['for_arch']
-        sack = dnf.sack.Sack(arch=for_arch)
-        repos = self.repo_cache.get_repos(repo_id)
-        if repos:
-            util.add_repos_to_sack(repo_id, repos, sack)
-            self.sack = sack
+    def load_sack(self, repo_id, srpm_repo, filelists):
+        # without SRPM repo, requires of source packages come from Koji
+        return self.sack_cache.get_sack(
+            repo_id, srpm_repo, filelists=filelists, view=self.srpm_view,
+            get_index=lambda sack: self.srpm_cache.get_index(sack))
+
+    def prepare_sack(self, repo_id, srpm_repo):
+        """
+        Loads sack for resolution. In filelists on demand mode, the sack is
+        loaded without filelists and sack with them is loaded only when some
+        package needs it.
+        """
+        self.has_filelists = not self.filelists_on_demand
+        self.sack, self.srpm_index = self.load_sack(repo_id, srpm_repo,
+                                                    self.has_filelists)
+        self.sack_args = repo_id, srpm_repo
+        self.filelists_state = None
+        self.group_base = None
+        self.dependency_graph = None
+
+
+class GenerationState(object):
+    """
+    Remembers what the last repo generation was based on, so that the next
+    one can resolve only packages affected by differences between repos.
+    """
+    def __init__(self, repo_id, nevras, srpms, comparison_builds, group=(),
+                 filelists_names=()):
+        self.repo_id = repo_id
+        # maps NEVRA strings of binary packages to their names
+        self.nevras = nevras
+        # maps package ids to EVRs of SRPMs used for resolution
+        self.srpms = srpms
+        # maps package ids to ids of builds used for comparison
+        self.comparison_builds = comparison_builds
+        # names of build group packages, changes of the group affect all
+        # packages
+        self.group = group
+        # names of packages that needed filelists, changes of files are not
+        # tracked, so they're always resolved again
+        self.filelists_names = filelists_names
 
 
 class GenerateRepoTask(AbstractResolverTask):
+    srpm_view = 'latest'
 
     def get_packages(self, expunge=True):
         packages = self.db.query(Package)\
@@ -235,85 +578,381 @@ class GenerateRepoTask(AbstractResolverTask):
         self.backend.register_real_builds(task_infos)
         self.srpm_cache.get_latest_srpms([i for (_, i) in task_infos.items()])
 
+    def evict_srpms(self):
+        """
+        Removes old SRPMs from cache, keeping the ones needed by builds whose
+        dependencies weren't processed yet and the latest ones of packages
+        that are not ignored
+        """
+        unprocessed = self.db.query(Package.name, Build.epoch, Build.version,
+                                    Build.release)\
+                             .join(Build, Build.package_id == Package.id)\
+                             .filter(Build.deps_processed == False)
+        tracked = self.db.query(Package.name)\
+                      .filter(Package.ignored == False)
+        self.srpm_cache.evict({tuple(nevr) for nevr in unprocessed},
+                              tracked={name for [name] in tracked})
+
     def update_repo_index(self, repo_id):
         index_path = os.path.join(util.config['directories']['repodata'], 'index')
         with open(index_path, 'w') as index:
             index.write('{}\n'.format(repo_id))
 
     def synchronize_resolution_state(self):
-        packages = self.get_packages(expunge=False)
-        for pkg in packages:
-            curr_state = self.resolved_packages.get(pkg.id)
-            if curr_state is not None:
+        """
+        Updates resolution state of packages whose state changed and emits
+        state change events for them. Other packages are not touched.
+        """
+        flipped = {pkg_id: self.resolved_packages[pkg_id]
+                   for pkg_id, resolved
+                   in self.db.query(Package.id, Package.resolved)
+                   if pkg_id in self.resolved_packages and
+                   self.resolved_packages[pkg_id] != resolved}
+        if flipped:
+            packages = self.db.query(Package)\
+                              .filter(Package.id.in_(flipped.keys()))\
+                              .options(joinedload(Package.last_complete_build))
+            for pkg in packages:
                 prev_state = pkg.msg_state_string
-                pkg.resolved = curr_state
+                pkg.resolved = flipped[pkg.id]
                 check_package_state(pkg, prev_state)
+            self.db.flush()
 
-        for state in True, False:
-            ids = [id for id, resolved in self.resolved_packages.iteritems()
-                   if resolved is state]
-            if ids:
-                self.db.query(Package).filter(Package.id.in_(ids))\
-                    .update({'resolved': state}, synchronize_session=False)
+    def update_resolution_problems(self, package_ids=None):
+        """
+        Replaces stored resolution problems of packages with given ids (all
+        packages if None) with problems found by this resolution. Only
+        problems that disappeared are deleted and only new ones inserted.
+        """
+        query = self.db.query(ResolutionProblem.id,
+                              ResolutionProblem.package_id,
+                              ResolutionProblem.problem)
+        if package_ids is not None:
+            query = query.filter(ResolutionProblem.package_id
+                                 .in_(package_ids))
+        current = {(entry['package_id'], entry['problem'])
+                   for entry in self.problems}
+        existing = set()
+        stale = []
+        for problem_id, package_id, problem in query:
+            key = package_id, problem
+            if key in current and key not in existing:
+                existing.add(key)
+            else:
+                stale.append(problem_id)
+        if stale:
+            self.db.query(ResolutionProblem)\
+                   .filter(ResolutionProblem.id.in_(stale))\
+                   .delete(synchronize_session=False)
+        # pylint: disable=E1101
+        bulk_insert(self.db, ResolutionProblem.__table__,
+                    (dict(package_id=package_id, problem=problem)
+                     for package_id, problem in current - existing))
+
+    def get_comparison_build_query(self, package_ids=None):
+        """
+        Returns query for pairs of (package_id, build_id) of newest builds
+        which should be used for dependency comparisons. build_id is None if
+        the package shouldn't be compared at all. Last build is used if it's
+        finished and its dependencies were resolved, if they were processed
+        but not resolved, the newest resolved build is used instead.
+        """
+        last_builds = self.db.query(Build.package_id,
+                                    func.max(Build.id).label('build_id'))\
+                             .group_by(Build.package_id)
+        resolved_builds = self.db.query(Build.package_id,
+                                        func.max(Build.id).label('build_id'))\
+                                 .filter(Build.deps_resolved == True)\
+                                 .group_by(Build.package_id)
+        if package_ids is not None:
+            last_builds = last_builds.filter(Build.package_id
+                                             .in_(package_ids))
+            resolved_builds = resolved_builds.filter(Build.package_id
+                                                     .in_(package_ids))
+        last_builds = last_builds.subquery()
+        resolved_builds = resolved_builds.subquery()
+        build_id = case([(Build.deps_resolved == True, Build.id),
+                         # unresolved build, skip it
+                         (Build.deps_processed == True,
+                          resolved_builds.c.build_id)])
+        return self.db.query(Build.package_id, build_id.label('build_id'))\
+                      .join(last_builds, Build.id == last_builds.c.build_id)\
+                      .outerjoin(resolved_builds,
+                                 Build.package_id ==
+                                 resolved_builds.c.package_id)\
+                      .filter(Build.state.in_(Build.FINISHED_STATES))
 
     def get_build_for_comparison(self, package):
         """
         Returns newest build which should be used for dependency
         comparisons or None if it shouldn't be compared at all
         """
-        last_build = package.last_build
-        if last_build and last_build.state in Build.FINISHED_STATES:
-            if last_build.deps_resolved:
-                return last_build
-            if last_build.deps_processed:
-                # unresolved build, skip it
-                return self.get_prev_build_for_comparison(last_build)
+        comparison = self.get_comparison_build_query([package.id]).first()
+        if comparison and comparison.build_id:
+            return self.db.query(Build).get(comparison.build_id)
 
-    def generate_dependency_changes(self, packages, repo_id):
-        changes = []
+    def get_comparison_deps(self, package_ids=None):
+        """
+        Loads dependencies of builds used for comparison of all packages (or
+        packages with given ids) in a single query. Yields pairs of
+        (package_id, deps) ordered by package_id.
+        """
+        comparison = self.get_comparison_build_query(package_ids).subquery()
+        deps = self.db.query(Dependency.package_id, Dependency.name,
+                             Dependency.epoch, Dependency.version,
+                             Dependency.release, Dependency.arch,
+                             Dependency.distance)\
+                      .select_from(comparison)\
+                      .join(Build, Build.id == comparison.c.build_id)\
+                      .join(Dependency,
+                            (Dependency.package_id == Build.package_id) &
+                            (Dependency.repo_id == Build.repo_id))\
+                      .order_by(Dependency.package_id)\
+                      .yield_per(10000)
+        for package_id, package_deps in itertools.groupby(
+                deps, lambda dep: dep.package_id):
+            yield package_id, list(package_deps)
+
+    def resolve_packages_serial(self, packages, repo_id):
         for package in packages:
             srpm = self.get_srpm_pkg(package.name)
-            if not srpm:
-                continue
-            curr_deps = self.resolve_dependencies(package, srpm, repo_id)
-            if curr_deps is not None:
-                last_build = self.get_build_for_comparison(package)
-                if last_build:
-                    prev_deps = self.get_deps_from_db(last_build.package_id,
-                                                      last_build.repo_id)
-                    if prev_deps is not None:
-                        changes += self.create_dependency_changes(prev_deps,
-                                                                  curr_deps,
-                                                                  package.id)
+            if srpm:
+                yield package, self.resolve_dependencies(package, srpm,
+                                                         repo_id)
+
+    def resolve_packages_parallel(self, packages, pool):
+        """
+        Resolves packages in given pool of forked worker processes, see
+        start_workers. Workers inherit already loaded sack from the parent
+        and send back only plain data, the database is accessed only by the
+        parent.
+        """
+        workers = util.config['dependency']['resolution_workers']
+        chunk_size = max(1, len(packages) // (workers * 4))
+        chunks = [[package.name for package in packages[i:i + chunk_size]]
+                  for i in range(0, len(packages), chunk_size)]
+        results = itertools.chain.from_iterable(
+            pool.imap(_resolve_in_worker, chunks))
+        for package, result in zip(packages, results):
+            if result is None:
+                # sack with filelists is loaded only by the parent
+                resolved, problems, deps = self.resolve_with_filelists(
+                    self.get_srpm_pkg(package.name))
+            else:
+                resolved, problems, deps = result
+                if deps is not None:
+                    deps = [Dependency(name=name, epoch=epoch,
+                                       version=version, release=release,
+                                       arch=arch, distance=distance)
+                            for name, epoch, version, release, arch,
+                            distance in deps]
+            self.record_resolution(package.id, resolved, problems)
+            yield package, deps
+
+    def start_workers(self):
+        """
+        Forks pool of resolution workers if more than one is configured,
+        returns None otherwise. The caller has to stop the pool with
+        stop_workers. Everything the workers share with the parent has to
+        be prepared before forking, including build group resolution, and
+        no other threads may be running, as the children would inherit
+        locks held by them.
+        """
+        global _worker_task
+        workers = util.config['dependency']['resolution_workers']
+        if workers <= 1:
+            return None
+        self.get_group_base()
+        self.repo_cache.join_prefetching()
+        _worker_task = self
+        return multiprocessing.Pool(workers)
+
+    def stop_workers(self, pool):
+        global _worker_task
+        if pool:
+            pool.terminate()
+            pool.join()
+        _worker_task = None
+
+    def resolve_packages(self, packages, repo_id, pool=None):
+        """
+        Resolves dependencies of given packages and yields pairs of
+        (package, deps). Packages without SRPM are skipped. Resolution runs
+        in given worker pool, if any.
+        """
+        if pool:
+            packages = [package for package in packages
+                        if self.get_srpm_pkg(package.name)]
+            return self.resolve_packages_parallel(packages, pool)
+        return self.resolve_packages_serial(packages, repo_id)
+
+    def generate_dependency_changes(self, packages, repo_id,
+                                    package_ids=None):
+        """
+        Resolves given packages and compares the results with dependencies
+        of their comparison builds. package_ids restricts which comparison
+        builds are loaded and should be given when resolving a small subset
+        of packages.
+        """
+        changes = []
+        # both resolution results and previous dependencies come ordered by
+        # package_id and are merged as they stream
+        packages = sorted(packages, key=lambda package: package.id)
+        comparison_deps = self.get_comparison_deps(package_ids)
+        prev_id, prev_deps = next(comparison_deps, (None, None))
+        pool = self.start_workers()
+        try:
+            for package, curr_deps in self.resolve_packages(packages, repo_id,
+                                                            pool):
+                while prev_id is not None and prev_id < package.id:
+                    prev_id, prev_deps = next(comparison_deps, (None, None))
+                if curr_deps is not None and prev_id == package.id:
+                    changes += self.create_dependency_changes(prev_deps,
+                                                              curr_deps,
+                                                              package.id)
+        finally:
+            self.stop_workers(pool)
         return changes
 
-    def run(self, repo_id):
+    def get_repo_packages(self):
+        return {str(pkg): pkg for pkg in hawkey.Query(self.sack)
+                if pkg.arch != 'src'}
+
+    def get_touched_names(self, prev_nevras, curr_pkgs):
+        """
+        Returns pair of sets of binary package names and SRPM names that may
+        resolve differently than in previous repo. Those are packages that
+        were added or removed and packages requiring something provided by
+        added packages, because those could be chosen as new providers.
+        """
+        touched = {name for nevra, name in prev_nevras.iteritems()
+                   if nevra not in curr_pkgs}
+        added = [pkg for nevra, pkg in curr_pkgs.iteritems()
+                 if nevra not in prev_nevras]
+        touched.update(pkg.name for pkg in added)
+        touched_srpms = set()
+        provides = [reldep for pkg in added for reldep in pkg.provides]
+        if provides:
+            touched.update(pkg.name for pkg in hawkey.Query(self.sack)
+                           .filter(requires=provides) if pkg.arch != 'src')
+            touched_srpms = self.srpm_index.get_requiring(provides)
+        return touched, touched_srpms
+
+    def get_dependency_users(self, names):
+        """
+        Returns ids of packages that had any of given names among
+        dependencies of their comparison builds or unapplied dependency
+        changes. Dependencies stored for older builds and repos don't affect
+        the next resolution.
+        """
+        if not names:
+            return set()
+        names = list(names)
+        comparison = self.get_comparison_build_query().subquery()
+        deps = self.db.query(Dependency.package_id)\
+                      .select_from(comparison)\
+                      .join(Build, Build.id == comparison.c.build_id)\
+                      .join(Dependency,
+                            (Dependency.package_id == Build.package_id) &
+                            (Dependency.repo_id == Build.repo_id))\
+                      .filter(Dependency.name.in_(names))
+        changes = self.db.query(DependencyChange.package_id)\
+                         .filter_by(applied_in_id=None)\
+                         .filter(DependencyChange.dep_name.in_(names))
+        return {pkg_id for [pkg_id] in deps.union(changes)}
+
+    def get_generation_state(self, repo_id, packages, repo_packages):
+        srpms = {}
+        for package in packages:
+            srpm = self.get_srpm_pkg(package.name)
+            if srpm:
+                srpms[package.id] = srpm.evr
+        comparison_builds = dict(self.get_comparison_build_query().all())
+        nevras = {nevra: pkg.name for nevra, pkg in repo_packages.iteritems()}
+        return GenerationState(repo_id, nevras, srpms, comparison_builds,
+                               self.group)
+
+    def can_resolve_incrementally(self, prev_state, curr_state, last_repo):
+        """
+        Returns whether only packages affected by repo changes can be
+        resolved. Previous state must come from the last generated repo and
+        have the same build group, which affects all packages.
+        """
+        return bool(util.config['dependency']['incremental_resolution'] and
+                    prev_state and prev_state.repo_id == last_repo and
+                    set(prev_state.group) == set(curr_state.group))
+
+    def get_affected_packages(self, packages, prev_state, curr_state,
+                              touched, touched_srpms):
+        """
+        Returns packages whose resolution may differ from the one done for
+        previous repo. Packages that were not successfully resolved, have no
+        build to compare with or needed filelists are always resolved again.
+        """
+        dep_users = self.get_dependency_users(touched)
+        affected = []
+        for package in packages:
+            build_id = curr_state.comparison_builds.get(package.id)
+            if (package.resolved is not True or build_id is None or
+                    package.id in dep_users or package.name in touched_srpms or
+                    package.name in prev_state.filelists_names or
+                    prev_state.srpms.get(package.id) !=
+                    curr_state.srpms.get(package.id) or
+                    prev_state.comparison_builds.get(package.id) != build_id):
+                affected.append(package)
+        return affected
+
+    def run(self, repo_id, prev_state=None):
+        """
+        Generates new repo and returns GenerationState that can be passed to
+        next run to resolve only packages affected by repo changes.
+        """
         start = time.time()
         self.log.info("Generating new repo")
+        [last_repo] = (self.db.query(Repo.repo_id)
+                       .order_by(Repo.repo_id.desc())
+                       .first() or [None])
         self.db.add(Repo(repo_id=repo_id))
         self.db.flush()
         packages = self.get_packages()
         self.refresh_latest_builds(packages)
+        self.evict_srpms()
         packages = self.get_packages()
-        srpm_repo = self.srpm_cache.get_repodata()
-        self.prepare_sack(repo_id)
+        srpm_repo = self.srpm_cache.get_repodata(
+            view=self.srpm_view, names=[package.name for package in packages])
+        self.prepare_sack(repo_id, srpm_repo)
         if not self.sack:
             self.log.error('Cannot generate repo: {}'.format(repo_id))
             return
         self.update_repo_index(repo_id)
-        util.add_repo_to_sack('src', srpm_repo, self.sack)
-        # TODO repo_id
-        self.group = util.get_build_group()
+        self.group = self.get_build_group(repo_id)
+        repo_packages = self.get_repo_packages()
+        state = self.get_generation_state(repo_id, packages, repo_packages)
+        to_resolve = packages
+        package_ids = None
+        if self.can_resolve_incrementally(prev_state, state, last_repo):
+            touched, touched_srpms = \
+                self.get_touched_names(prev_state.nevras, repo_packages)
+            to_resolve = self.get_affected_packages(packages, prev_state,
+                                                    state, touched,
+                                                    touched_srpms)
+            package_ids = [package.id for package in to_resolve]
+            self.log.info("Repo {} touches {} names since repo {}, "
+                          "resolving {} of {} packages"
+                          .format(repo_id, len(touched), last_repo,
+                                  len(to_resolve), len(packages)))
         self.log.info("Resolving dependencies")
         resolution_start = time.time()
-        changes = self.generate_dependency_changes(packages, repo_id)
+        changes = self.generate_dependency_changes(to_resolve, repo_id,
+                                                   package_ids)
+        state.filelists_names = self.filelists_names
+        if self.filelists_on_demand:
+            self.log.info("{} packages needed filelists"
+                          .format(len(self.filelists_names)))
         resolution_end = time.time()
-        self.db.query(ResolutionProblem).delete(synchronize_session=False)
-        # pylint: disable=E1101
-        if self.problems:
-            self.db.execute(ResolutionProblem.__table__.insert(), self.problems)
+        self.update_resolution_problems(package_ids)
         self.synchronize_resolution_state()
-        self.update_dependency_changes(changes)
+        self.update_dependency_changes(changes, package_ids=package_ids)
         self.db.commit()
         end = time.time()
 
@@ -321,8 +960,10 @@ class GenerateRepoTask(AbstractResolverTask):
                        "Overall time: {} minutes.")
                       .format((resolution_end - resolution_start) / 60,
                               (end - start) / 60))
+        return state
 
 class ProcessBuildsTask(AbstractResolverTask):
+    srpm_view = 'builds'
 
     def process_build(self, build):
         if build.repo_id:
@@ -364,22 +1005,21 @@ class ProcessBuildsTask(AbstractResolverTask):
                              .filter(Build.repo_id != None)\
                              .options(joinedload(Build.package))\
                              .order_by(Build.repo_id).all()
-        # TODO repo_id
-        self.group = util.get_build_group()
 
         # do this before processing to avoid multiple runs of createrepo
-        for build in unprocessed:
-            self.srpm_cache.get_srpm(build.package.name, build.epoch,
-                                     build.version, build.release)
-        srpm_repo = self.srpm_cache.get_repodata()
+        nevrs = [(build.package.name, build.epoch, build.version,
+                  build.release) for build in unprocessed]
+        self.srpm_cache.get_srpms(nevrs)
+        srpm_repo = self.srpm_cache.get_repodata(view=self.srpm_view,
+                                                 nevrs=nevrs)
 
         for repo_id, builds in itertools.groupby(unprocessed,
                                                  lambda build: build.repo_id):
             builds = list(builds)
             if repo_id is not None:
-                self.prepare_sack(repo_id)
+                self.prepare_sack(repo_id, srpm_repo)
                 if self.sack:
-                    util.add_repos_to_sack('srpm', {'src': srpm_repo}, self.sack)
+                    self.group = self.get_build_group(repo_id)
                     for build in builds:
                         self.process_build(build)
             self.db.query(Build).filter(Build.id.in_([b.id for b in builds]))\
@@ -387,23 +1027,53 @@ class ProcessBuildsTask(AbstractResolverTask):
                                         synchronize_session=False)
             self.db.commit()
 
+# Task used by forked resolution workers, set by parent before forking
+_worker_task = None
+
+
+def _resolve_in_worker(names):
+    task = _worker_task
+    results = []
+    for name in names:
+        srpm = task.get_srpm_pkg(name)
+        result = task.resolve_in_sack(srpm)
+        if result is not None:
+            resolved, problems, deps = result
+            if deps is not None:
+                deps = [(dep.name, dep.epoch, dep.version, dep.release,
+                         dep.arch, dep.distance) for dep in deps]
+            result = resolved, problems, deps
+        # None is resolved with filelists by the parent
+        results.append(result)
+    return results
+
+
 class Resolver(KojiService):
 
     def __init__(self, log=None, db=None, koji_session=None,
-                 srpm_cache=None, repo_cache=None, backend=None):
+                 srpm_cache=None, repo_cache=None, sack_cache=None,
+                 backend=None):
         super(Resolver, self).__init__(log=log, db=db,
                                        koji_session=koji_session)
-        self.srpm_cache = (srpm_cache
-                           or SRPMCache(koji_session=self.koji_session))
+        if not srpm_cache:
+            if util.config['dependency']['source_requires'] == 'koji':
+                srpm_cache = RequiresCache(koji_session=self.koji_session)
+            else:
+                srpm_cache = SRPMCache(koji_session=self.koji_session)
+        self.srpm_cache = srpm_cache
         self.repo_cache = repo_cache or RepoCache()
+        self.sack_cache = sack_cache or SackCache(self.repo_cache)
         self.backend = backend or Backend(db=self.db,
                                           koji_session=self.koji_session,
                                           log=self.log)
+        self.generation_state = None
+        self.build_groups = OrderedDict()
 
     def create_task(self, cls):
         return cls(log=self.log, db=self.db, koji_session=self.koji_session,
                    srpm_cache=self.srpm_cache, repo_cache=self.repo_cache,
-                   backend=self.backend)
+                   sack_cache=self.sack_cache, backend=self.backend,
+                   build_groups=self.build_groups)
 
     def process_repo_generation_requests(self):
         latest_request = self.db.query(RepoGenerationRequest)\
@@ -416,12 +1086,31 @@ class Resolver(KojiService):
                            .order_by(Repo.repo_id.desc())
                            .first() or [0])
             if repo_id > last_repo:
-                self.create_task(GenerateRepoTask).run(repo_id)
+                self.generation_state = self.create_task(GenerateRepoTask)\
+                                            .run(repo_id, self.generation_state)
             self.db.query(RepoGenerationRequest)\
                    .filter(RepoGenerationRequest.repo_id <= repo_id)\
                    .delete()
             self.db.commit()
 
+    def prefetch_repos(self):
+        """
+        Starts background download of repos that will be needed for repo
+        generation and for processing of builds, so that they're ready when
+        the tasks get to them.
+        """
+        [latest_request] = self.db.query(func.max(RepoGenerationRequest
+                                                  .repo_id)).one()
+        if latest_request:
+            self.repo_cache.prefetch(latest_request)
+        build_repos = self.db.query(Build.repo_id)\
+                             .filter_by(deps_processed=False)\
+                             .filter(Build.repo_id != None)\
+                             .distinct().order_by(Build.repo_id)
+        for [repo_id] in build_repos:
+            self.repo_cache.prefetch(repo_id)
+
     def main(self):
+        self.prefetch_repos()
         self.create_task(ProcessBuildsTask).run()
         self.process_repo_generation_requests()
@@ -0,0 +1,161 @@
+# Copyright (C) 2015  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import hashlib
+import logging
+import collections
+import hawkey
+import dnf.sack
+
+from koschei import util
+
+log = logging.getLogger('koschei.sack_cache')
+
+
+def get_rss():
+    """ Returns resident set size of current process in bytes """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def get_repodata_size(repo_result, filelists):
+    """
+    Returns size in bytes of repodata files of given librepo result that
+    are loaded into a sack
+    """
+    repodata = repo_result.yum_repo
+    names = ['primary', 'filelists'] if filelists else ['primary']
+    return sum(os.path.getsize(repodata[name]) for name in names)
+
+
+def get_repodata_checksum(repo_result):
+    with open(repo_result.yum_repo['repomd'], 'rb') as repomd:
+        return hashlib.sha256(repomd.read()).hexdigest()
+
+
+class SRPMIndex(object):
+    """
+    Index of source packages in a sack by name (latest version) and by name
+    and EVR, built in a single pass over the sack.
+    """
+
+    def __init__(self, sack):
+        self._sack = sack
+        self._latest = {}
+        self._by_nevr = {}
+        for pkg in hawkey.Query(sack).filter(arch='src'):
+            self._by_nevr[pkg.name, pkg.epoch, pkg.version, pkg.release] = pkg
+            latest = self._latest.get(pkg.name)
+            if latest is None or pkg.evr_gt(latest):
+                self._latest[pkg.name] = pkg
+
+    def get(self, name, evr=None):
+        if evr:
+            epoch, version, release = evr
+            return self._by_nevr.get((name, epoch or 0, version, release))
+        return self._latest.get(name)
+
+    def get_requiring(self, provides):
+        """ Returns names of source packages that require any of given reldeps """
+        return {pkg.name for pkg in hawkey.Query(self._sack)
+                .filter(requires=provides, arch='src')}
+
+
+class SackCache(object):
+    """
+    Keeps loaded sacks containing Koji repo and SRPM repo in memory, together
+    with index of their SRPMs. Sacks are keyed by repo_id, name of the SRPM
+    view and whether filelists were loaded, so that sacks of different views
+    don't replace each other. Sack whose SRPM repodata changed since it was
+    loaded is loaded again. Sacks are evicted in LRU order when their total
+    size exceeds the budget. Size of a sack is measured by size of the
+    repodata it was loaded from, memory taken by a sack is roughly
+    proportional to it, unlike RSS which depends on what else the process
+    allocated meanwhile.
+    """
+
+    def __init__(self, repo_cache, max_size=None):
+        self._repo_cache = repo_cache
+        if max_size is None:
+            max_size = util.config['dependency']['sack_cache_size']
+        self._max_size = max_size * 1024 * 1024
+        # maps keys to tuples of (checksum of SRPM repodata, sack,
+        # srpm_index, size of loaded repodata in bytes)
+        self._sacks = collections.OrderedDict()
+
+    def _load_sack(self, repo_id, srpm_repo, filelists):
+        """
+        Returns pair of (sack, size of loaded repodata) or (None, 0) if the
+        repo is not available.
+        """
+        # repo files must not be evicted by prefetching threads while
+        # they're being loaded
+        with self._repo_cache.use_repos(repo_id) as repos:
+            if repos:
+                size = sum(get_repodata_size(repo_result, filelists)
+                           for repo_result in repos.values())
+                for_arch = util.config['dependency']['for_arch']
+                sack = dnf.sack.Sack(arch=for_arch, make_cache_dir=True,
+                                     cachedir=self._repo_cache
+                                     .get_cache_dir(repo_id))
+                util.add_repos_to_sack(repo_id, repos, sack, build_cache=True,
+                                       load_filelists=filelists)
+                if srpm_repo:
+                    util.add_repo_to_sack('src', srpm_repo, sack,
+                                          load_filelists=filelists)
+                    size += get_repodata_size(srpm_repo, filelists)
+                return sack, size
+        return None, 0
+
+    def _evict(self):
+        # the most recently used sack is never evicted
+        while (len(self._sacks) > 1 and
+               sum(entry[3] for entry in self._sacks.values())
+               > self._max_size):
+            (repo_id, view, _), _ = self._sacks.popitem(last=False)
+            log.debug("Evicting sack for repo {} ({})".format(repo_id, view))
+
+    def get_sack(self, repo_id, srpm_repo, filelists=True, view=None,
+                 get_index=None):
+        """
+        Returns pair of (sack, srpm_index) or (None, None) if the repo is not
+        available. If there's no SRPM repo, the sack contains only binary
+        packages and srpm_index is obtained by calling get_index with the
+        sack when the sack is loaded, or None if it's not given. Without
+        filelists, the sack has only file provides listed in primary. View is
+        the name of the SRPM repo view, sacks of different views are cached
+        independently.
+        """
+        key = (repo_id, view, filelists)
+        checksum = srpm_repo and get_repodata_checksum(srpm_repo)
+        entry = self._sacks.pop(key, None)
+        if entry is None or entry[0] != checksum:
+            # sacks of the view with outdated SRPM repo won't be used anymore
+            for outdated in [k for k, e in self._sacks.iteritems()
+                             if k[:2] == key[:2] and e[0] != checksum]:
+                del self._sacks[outdated]
+            sack, size = self._load_sack(repo_id, srpm_repo, filelists)
+            if not sack:
+                return None, None
+            if srpm_repo:
+                srpm_index = SRPMIndex(sack)
+            else:
+                srpm_index = get_index(sack) if get_index else None
+            entry = checksum, sack, srpm_index, size
+        self._sacks[key] = entry
+        self._evict()
+        return entry[1:3]
@@ -18,29 +18,20 @@
 
 from __future__ import print_function
 
-import math
-
-from datetime import datetime
-from sqlalchemy import (func, union_all, extract, cast, Integer, case, null,
-                        literal_column)
-from sqlalchemy.sql.functions import coalesce
+import time
 
 from . import util
-from .models import Package, Build, DependencyChange
+from .models import Package, Build
 from .service import KojiService
 from .backend import Backend
 
 
-def hours_since(what):
-    return extract('EPOCH', datetime.now() - what) / 3600
-
-
 class Scheduler(KojiService):
     koji_anonymous = False
 
     priority_conf = util.config['priorities']
     priority_threshold = priority_conf['build_threshold']
-    failed_priority = priority_conf['failed_build_priority']
+    time_refresh = priority_conf['time_refresh']
     max_builds = util.config['koji_config']['max_builds']
     load_threshold = util.config['koji_config']['load_threshold']
 
@@ -49,93 +40,45 @@ class Scheduler(KojiService):
         self.backend = backend or Backend(log=self.log,
                                           db=self.db,
                                           koji_session=self.koji_session)
-
-    def get_dependency_priority_query(self):
-        update_weight = self.priority_conf['package_update']
-        distance = coalesce(DependencyChange.distance, 8)
-        return self.db.query(DependencyChange.package_id.label('pkg_id'),
-                             (update_weight / distance)
-                             .label('priority'))\
-                      .filter_by(applied_in_id=None)
-
-    def get_time_priority_query(self):
-        t0 = self.priority_conf['t0']
-        t1 = self.priority_conf['t1']
-        a = self.priority_threshold / (math.log10(t1) - math.log10(t0))
-        b = -a * math.log10(t0)
-        time_expr = func.greatest(a * func.log(
-            hours_since(func.max(Build.started)) + 0.00001) + b, -30)
-        return self.db.query(Build.package_id.label('pkg_id'),
-                             time_expr.label('priority'))\
-                      .group_by(Build.package_id)
-
-    def get_failed_build_priority_query(self):
-        rank = func.rank().over(partition_by=Package.id,
-                                order_by=Build.id.desc()).label('rank')
-        sub = self.db.query(Package.id.label('pkg_id'), Build.state, rank)\
-                     .outerjoin(Build,
-                                Package.id == Build.package_id)\
-                     .subquery()
-        return self.db.query(sub.c.pkg_id,
-                             literal_column(str(self.failed_priority))
-                             .label('priority'))\
-                      .filter(((sub.c.rank == 1) & (sub.c.state == 5)) |
-                              ((sub.c.rank == 2) & (sub.c.state != 5)))\
-                      .group_by(sub.c.pkg_id)\
-                      .having(func.count(sub.c.pkg_id) == 2)
-
-    def get_priority_queries(self):
-        prio = (('manual', Package.manual_priority),
-                ('static', Package.static_priority))
-        priorities = {name: self.db.query(Package.id.label('pkg_id'),
-                                          col.label('priority'))
-                      for name, col in prio}
-        priorities['dependency'] = self.get_dependency_priority_query()
-        priorities['time'] = self.get_time_priority_query()
-        priorities['failed_build'] = self.get_failed_build_priority_query()
-        return priorities
+        self.time_refreshed = None
+
+    def refresh_time_priorities(self):
+        """
+        Time priorities grow as time passes without any event, so they're
+        recomputed once per time_refresh seconds.
+        """
+        now = time.time()
+        if (self.time_refreshed is None or
+                now - self.time_refreshed >= self.time_refresh):
+            self.backend.update_time_priorities()
+            self.db.commit()
+            self.time_refreshed = now
 
     def get_scheduled_package(self):
+        """
+        Returns package with the highest current priority among those that
+        can be built, if its priority is above the threshold and Koji isn't
+        overloaded. Priorities are maintained by backend as their
+        components change.
+        """
+        self.refresh_time_priorities()
         incomplete_builds = self.db.query(Build.package_id)\
                                 .filter(Build.state == Build.RUNNING)
-        queries = self.get_priority_queries().values()
-        union_query = union_all(*queries).alias('un')
-        pkg_id = union_query.c.pkg_id
-        current_priority = cast(func.sum(union_query.c.priority),
-                                Integer).label('curr_priority')
-        priorities = self.db.query(pkg_id, current_priority)\
-                            .group_by(pkg_id).subquery()
-        prioritized = self.db.query(Package.id, priorities.c.curr_priority)\
-                             .join(priorities,
-                                   Package.id == priorities.c.pkg_id)\
-                             .filter((Package.resolved == True) |
-                                     (Package.resolved == None))\
-                             .filter(Package.id.notin_(
-                                 incomplete_builds.subquery()))\
-                             .filter(Package.ignored == False)\
-                             .order_by(priorities.c.curr_priority.desc())\
-                             .all()
-
-        if not prioritized or incomplete_builds.count() >= self.max_builds:
+        if incomplete_builds.count() >= self.max_builds:
             return None
-
-        self.db.rollback()
-        self.lock_package_table()
-        # pylint: disable=E1101
-        self.db.execute(Package.__table__.update()
-                        .values(current_priority=case(prioritized,
-                                                      value=Package.id,
-                                                      else_=null())))
-        self.db.commit()
-        package = self.db.query(Package).get(prioritized[0][0])
-        if (package.current_priority >= self.priority_threshold
+        package = self.db.query(Package)\
+                         .filter((Package.resolved == True) |
+                                 (Package.resolved == None))\
+                         .filter(Package.id.notin_(
+                             incomplete_builds.subquery()))\
+                         .filter(Package.ignored == False)\
+                         .order_by(Package.current_priority.desc())\
+                         .first()
+        if (package and package.current_priority >= self.priority_threshold
                 and util.get_koji_load(self.koji_session)
                 < self.load_threshold):
             return package
 
-    def lock_package_table(self):
-        self.db.execute("LOCK TABLE package IN EXCLUSIVE MODE;")
-
     def main(self):
         package = self.get_scheduled_package()
         if package:
@@ -20,91 +20,215 @@ import koji
 import librepo
 import logging
 import os
-import shutil
+import sqlite3
 import subprocess
+import time
 import rpm
 
+from collections import defaultdict
+
 from koschei import util
 from koschei.util import itercall
 
 log = logging.getLogger('koschei.srpm_cache')
 
 pathinfo = koji.PathInfo(topdir=util.koji_config['topurl'])
-source_tag = util.koji_config['source_tag']
+
+# NEVRs of cached SRPMs, so that headers don't need to be parsed on startup
+INDEX_FILE = 'srpm_index.sqlite'
+# repos containing subsets of the cache
+VIEW_DIR = 'views'
+
+
+def get_srpm_nvra(nevr):
+    name, _, version, release = nevr
+    return '{}-{}-{}.src'.format(name, version, release)
+
+
+def get_outdated(nevrs, keep):
+    """
+    Returns NEVRs that are not among the latest `keep` NEVRs of their package
+    """
+    by_name = defaultdict(list)
+    for nevr in nevrs:
+        by_name[nevr[0]].append(nevr)
+    outdated = []
+    for nevrs in by_name.itervalues():
+        nevrs.sort(cmp=lambda a, b: util.compare_evr(a[1:], b[1:]),
+                   reverse=True)
+        outdated += nevrs[keep:]
+    return outdated
 
 
 class SRPMCache(object):
 
     def __init__(self, koji_session,
-                 srpm_dir=util.config['directories']['srpms']):
+                 srpm_dir=util.config['directories']['srpms'],
+                 keep=util.config['dependency']['srpm_cache_keep'],
+                 max_size=util.config['dependency']['srpm_cache_size']):
         self._srpm_dir = srpm_dir
         self._koji_session = koji_session
-        repodata_dir = os.path.join(srpm_dir, 'repodata')
-        if os.path.exists(repodata_dir):
-            shutil.rmtree(repodata_dir)
+        self._keep = keep
+        self._max_size = max_size * 1024 * 1024
         self._cache = {}
+        # filename -> time of last use, not yet written to index
+        self._used = {}
         self._dirty = True
         self._read_existing_srpms()
 
+    def _open_index(self):
+        index = sqlite3.connect(os.path.join(self._srpm_dir, INDEX_FILE))
+        index.text_factory = str
+        index.execute("""CREATE TABLE IF NOT EXISTS srpm(
+                             filename TEXT PRIMARY KEY,
+                             size INTEGER NOT NULL,
+                             mtime REAL NOT NULL,
+                             name TEXT NOT NULL,
+                             epoch INTEGER,
+                             version TEXT NOT NULL,
+                             release TEXT NOT NULL,
+                             last_used REAL NOT NULL)""")
+        return index
+
+    def _index_srpm(self, path, nevr):
+        stat = os.stat(path)
+        self._index.execute("INSERT OR REPLACE INTO srpm "
+                            "VALUES (?,?,?,?,?,?,?,?)",
+                            (os.path.basename(path), stat.st_size,
+                             stat.st_mtime) + tuple(nevr) + (time.time(),))
+
     def _read_existing_srpms(self):
+        self._index = self._open_index()
+        indexed = {row[0]: row[1:] for row in
+                   self._index.execute("SELECT * FROM srpm")}
         srpms = os.listdir(self._srpm_dir)
         ts = rpm.TransactionSet()
         for srpm in srpms:
             if not srpm.endswith('.rpm'):
                 continue
             path = os.path.join(self._srpm_dir, srpm)
+            entry = indexed.pop(srpm, None)
+            stat = os.stat(path)
+            if entry and entry[:2] == (stat.st_size, stat.st_mtime):
+                self._cache[entry[2:6]] = path
+                continue
+            fd = None
             try:
                 fd = os.open(path, os.O_RDONLY)
                 hdr = ts.hdrFromFdno(fd)
                 nevr = (hdr['name'], hdr['epoch'], hdr['version'],
                         hdr['release'])
                 self._cache[nevr] = path
+                self._index_srpm(path, nevr)
             except rpm.error as e:
                 log.warn("Unreadable rpm in srpm_dir: {}\nRPM error: {}"
                          .format(path, e.message))
             finally:
                 if fd:
                     os.close(fd)
+        # remaining entries belong to files that no longer exist
+        self._index.executemany("DELETE FROM srpm WHERE filename = ?",
+                                [(srpm,) for srpm in indexed])
+        self._index.commit()
+
+    def _download_srpms(self, srpms):
+        urls = [pathinfo.build(srpm) + '/' + pathinfo.rpm(srpm)
+                for srpm in srpms]
+        paths = util.download_rpm_headers(urls, self._srpm_dir)
+
+        for srpm, path in zip(srpms, paths):
+            if path:
+                nevr = (srpm['name'], srpm['epoch'], srpm['version'],
+                        srpm['release'])
+                self._cache[nevr] = path
+                self._index_srpm(path, nevr)
+                self._dirty = True
+        self._index.commit()
+
+    def get_srpms(self, nevrs):
+        """
+        Makes sure SRPMs of given NEVRs are in the cache. Missing SRPMs are
+        looked up by NVRA in a single multicall pass and downloaded
+        concurrently.
+        """
+        now = time.time()
+        missing = []
+        for nevr in nevrs:
+            cached = self._cache.get(nevr)
+            if cached:
+                self._used[os.path.basename(cached)] = now
+            elif nevr not in missing:
+                missing.append(nevr)
+        srpms = itercall(self._koji_session, missing,
+                         lambda k, nevr: k.getRPM(get_srpm_nvra(nevr)))
+        self._download_srpms([srpm for nevr, srpm in zip(missing, srpms)
+                              if srpm and srpm['epoch'] == nevr[1]])
 
     def get_srpm(self, name, epoch, version, release):
         nevr = name, epoch, version, release
-        cached = self._cache.get(nevr)
-        if cached:
-            return cached
-        self._dirty = True
-        builds = self._koji_session.listTagged(source_tag, package=name)
-        for build in builds:
-            if (build['epoch'] == epoch and build['version'] == version and
-                    build['release'] == release):
-                srpms = self._koji_session.listRPMs(buildID=build['build_id'],
-                                                    arches='src')
-                if srpms:
-                    build_url = pathinfo.build(build)
-                    srpm_name = pathinfo.rpm(srpms[0])
-                    path = util.download_rpm_header(
-                        build_url + '/' + srpm_name, self._srpm_dir)
-                    self._cache[nevr] = path
-                    return path
+        self.get_srpms([nevr])
+        return self._cache.get(nevr)
 
     def get_latest_srpms(self, task_infos):
-        urls = map(pathinfo.build, task_infos)
-        srpms = itercall(self._koji_session, task_infos,
-                         lambda k, i: k.listRPMs(buildID=i['build_id'],
-                                                 arches='src'))
-
-        for [srpm], build_url in zip(srpms, urls):
-            srpm_url = pathinfo.rpm(srpm)
-            srpm_name = os.path.basename(srpm_url)
-            util.download_rpm_header(
-                build_url + '/' + srpm_url, self._srpm_dir)
-            nevr = (srpm['name'], srpm['epoch'], srpm['version'],
-                    srpm['release'])
-            self._cache[nevr] = os.path.join(self._srpm_dir, srpm_name)
-            self._dirty = True
-
-    def _createrepo(self):
+        srpms = [srpm for [srpm] in
+                 itercall(self._koji_session, task_infos,
+                          lambda k, i: k.listRPMs(buildID=i['build_id'],
+                                                  arches='src'))]
+        self._download_srpms(srpms)
+
+    def _remove(self, nevr):
+        path = self._cache.pop(nevr)
+        log.debug("Evicting {} from srpm_dir".format(path))
+        os.unlink(path)
+        self._index.execute("DELETE FROM srpm WHERE filename = ?",
+                            (os.path.basename(path),))
+        self._used.pop(os.path.basename(path), None)
+        self._dirty = True
+
+    def evict(self, protected=(), tracked=()):
+        """
+        Removes SRPMs that are not among the latest `keep` NEVRs of their
+        package. If the total size exceeds the limit, least recently used SRPMs
+        are removed as well, except for the latest `keep` NEVRs of packages
+        named in `tracked`. SRPMs with NEVRs in `protected` are never removed.
+        Repodata are regenerated by next get_repodata call.
+        """
+        protected = set(protected)
+        self._index.executemany("UPDATE srpm SET last_used = ? "
+                                "WHERE filename = ?",
+                                [(last_used, filename) for filename, last_used
+                                 in self._used.iteritems()])
+        self._used = {}
+        if self._keep:
+            for nevr in get_outdated(self._cache, self._keep):
+                if nevr not in protected:
+                    self._remove(nevr)
+        if self._max_size:
+            tracked = set(tracked)
+            outdated = set(get_outdated(self._cache, self._keep))
+            protected.update(nevr for nevr in self._cache
+                             if nevr[0] in tracked and nevr not in outdated)
+            nevrs = {os.path.basename(path): nevr
+                     for nevr, path in self._cache.iteritems()}
+            entries = self._index.execute("SELECT filename, size FROM srpm "
+                                          "ORDER BY last_used").fetchall()
+            total_size = sum(size for _, size in entries)
+            for filename, size in entries:
+                if total_size <= self._max_size:
+                    break
+                nevr = nevrs.get(filename)
+                if nevr and nevr not in protected:
+                    self._remove(nevr)
+                    total_size -= size
+        self._index.commit()
+
+    def _createrepo(self, *args):
+        # existing repodata are updated, only headers of files that are not
+        # there yet are read, files in cache never change
         log.debug('createrepo_c')
-        createrepo = subprocess.Popen(['createrepo_c', self._srpm_dir],
+        createrepo = subprocess.Popen(['createrepo_c', '--update',
+                                       '--skip-stat', '--no-database'] +
+                                      list(args) + [self._srpm_dir],
                                       stdout=subprocess.PIPE,
                                       stderr=subprocess.PIPE)
         out, err = createrepo.communicate()
@@ -113,13 +237,54 @@ class SRPMCache(object):
             raise Exception("Createrepo failed: return code {ret}\n{err}"
                             .format(ret=ret, err=err))
         log.debug(out)
-        self._dirty = False
 
-    def get_repodata(self):
+    def _get_latest_paths(self, names):
+        names = set(names)
+        latest = {}
+        for nevr in self._cache:
+            if nevr[0] in names:
+                prev = latest.get(nevr[0])
+                if prev is None or util.compare_evr(nevr[1:], prev[1:]) > 0:
+                    latest[nevr[0]] = nevr
+        return [self._cache[nevr] for nevr in latest.itervalues()]
+
+    def _create_view(self, view, paths):
+        view_dir = os.path.join(self._srpm_dir, VIEW_DIR, view)
+        pkglist_path = os.path.join(view_dir, 'pkglist')
+        pkglist = ''.join(os.path.basename(path) + '\n'
+                          for path in sorted(set(paths)))
+        if not os.path.exists(view_dir):
+            os.makedirs(view_dir)
+        elif os.path.exists(os.path.join(view_dir, 'repodata')):
+            with open(pkglist_path) as pkglist_file:
+                if pkglist_file.read() == pkglist:
+                    return view_dir
+        with open(pkglist_path, 'w') as pkglist_file:
+            pkglist_file.write(pkglist)
+        # metadata of the whole cache are reused, no headers are read
+        self._createrepo('--pkglist', pkglist_path,
+                         '--update-md-path', self._srpm_dir,
+                         '--outputdir', view_dir)
+        return view_dir
+
+    def get_repodata(self, view=None, names=(), nevrs=()):
+        """
+        Returns librepo result for repo of all cached SRPMs. If view name is
+        given, returns repo of that name containing only the latest SRPMs of
+        given package names and SRPMs of given NEVRs, so that the sack
+        doesn't contain whole history of the cache.
+        """
         if self._dirty:
             self._createrepo()
+            self._dirty = False
+        repo_dir = self._srpm_dir
+        if view:
+            paths = self._get_latest_paths(names)
+            paths += [self._cache[nevr] for nevr in nevrs
+                      if nevr in self._cache]
+            repo_dir = self._create_view(view, paths)
         h = librepo.Handle()
         h.local = True
         h.repotype = librepo.LR_YUMREPO
-        h.urls = [self._srpm_dir]
+        h.urls = [repo_dir]
         return h.perform(librepo.Result())
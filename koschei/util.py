@@ -23,11 +23,18 @@ import rpm
 import koji
 import logging
 import logging.config
-import subprocess
 import hawkey
 import librepo
 import shutil
 import errno
+import struct
+import tempfile
+import threading
+import requests
+import requests.adapters
+
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
 
 from datetime import datetime
 
@@ -162,27 +169,130 @@ def mkdir_if_absent(path):
             raise
 
 
-def reset_sigpipe():
-    import signal
-    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
-
-
-def download_rpm_header(url, target_dir):
+RPM_LEAD_SIZE = 96
+RPM_HEADER_MAGIC = '\x8e\xad\xe8'
+RPM_HEADER_CHUNK = 64 * 1024
+
+_http_session = None
+# guards creation of _http_session, which is first requested from download
+# threads
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Returns HTTP session shared by the process, which keeps connections
+    alive in a pool big enough for all download threads.
+    """
+    global _http_session
+    with _http_session_lock:
+        if not _http_session:
+            threads = dep_config['srpm_download_threads']
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=threads)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+    return _http_session
+
+
+def get_rpm_header_size(data):
+    """
+    Returns size of RPM lead, signature and header, which are all that is
+    needed to read RPM metadata, given starting bytes of RPM file. Returns
+    None if given data is too short to determine the size.
+    """
+    offset = RPM_LEAD_SIZE
+    # signature is padded to 8 bytes, header is not
+    for padded in True, False:
+        if len(data) < offset + 16:
+            return None
+        if data[offset:offset + 3] != RPM_HEADER_MAGIC:
+            raise IOError("Invalid RPM header")
+        nindex, hsize = struct.unpack('>II', data[offset + 8:offset + 16])
+        offset += 16 + 16 * nindex + hsize
+        if padded:
+            offset += -offset % 8
+    return offset
+
+
+def fetch_rpm_header(url, session=None):
+    """
+    Downloads only leading part of RPM file that contains its header using
+    HTTP range requests. If the server doesn't support them, the download is
+    interrupted after the header is read.
+    """
+    session = session or get_http_session()
+    data = ''
+    size = None
+    while size is None or len(data) < size:
+        end = max(size or 0, len(data) + RPM_HEADER_CHUNK) - 1
+        response = session.get(url, stream=True, timeout=60,
+                               headers={'Range': 'bytes={}-{}'
+                                                 .format(len(data), end)})
+        try:
+            response.raise_for_status()
+            if response.status_code != 206:
+                data = ''
+                for chunk in response.iter_content(RPM_HEADER_CHUNK):
+                    data += chunk
+                    size = get_rpm_header_size(data)
+                    if size is not None and len(data) >= size:
+                        return data[:size]
+                raise IOError("Truncated RPM: " + url)
+            chunk = response.content
+        finally:
+            response.close()
+        if not chunk:
+            raise IOError("Truncated RPM: " + url)
+        data += chunk
+        size = get_rpm_header_size(data)
+    return data[:size]
+
+
+def download_rpm_header(url, target_dir, session=None):
+    """
+    Downloads RPM header into target_dir unless it's already there. The file
+    is written under a temporary name and atomically renamed, so concurrent
+    downloads don't interfere. Returns path to the file.
+    """
     mkdir_if_absent(target_dir)
     rpm_path = os.path.join(target_dir, os.path.basename(url))
     if not os.path.isfile(rpm_path):
-        tmp_filename = os.path.join(target_dir, '.rpm.tmp')
         log.info('downloading {}'.format(rpm_path))
-        cmd = 'curl -s {} | tee {} | rpm -qp /dev/fd/0'.format(url,
-                                                               tmp_filename)
-        with open(os.devnull, 'w') as devnull:
-            subprocess.call(['bash', '-e', '-c', cmd],
-                            preexec_fn=reset_sigpipe,
-                            stdout=devnull)
-        os.rename(tmp_filename, rpm_path)
+        header = fetch_rpm_header(url, session)
+        fd, tmp_path = tempfile.mkstemp(dir=target_dir, prefix='.',
+                                        suffix='.rpm.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(header)
+            os.rename(tmp_path, rpm_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
     return rpm_path
 
 
+def download_rpm_headers(urls, target_dir):
+    """
+    Downloads RPM headers concurrently. Returns list of paths in the same
+    order as urls, with None in place of those that failed to download.
+    """
+    def download(url):
+        try:
+            return download_rpm_header(url, target_dir)
+        except (IOError, requests.exceptions.RequestException) as e:
+            log.warn("Cannot download {}: {}".format(url, e))
+    if not urls:
+        return []
+    pool = ThreadPool(min(len(urls), dep_config['srpm_download_threads']))
+    try:
+        return pool.map(download, urls)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def get_srpm_repodata():
     h = librepo.Handle()
     h.local = True
@@ -221,28 +331,48 @@ def load_local_repos():
     return repos
 
 
-def add_repo_to_sack(repoid, repo_result, sack):
+def add_repo_to_sack(repoid, repo_result, sack, build_cache=False,
+                     load_filelists=True):
+    """
+    Loads repo into the sack. When build_cache is set, libsolv cache of the
+    repo is written to sack's cachedir and used by subsequent loads as long
+    as the repomd checksum matches. Without load_filelists, only file
+    provides listed in primary are available.
+    """
     repodata = repo_result.yum_repo
     repo = hawkey.Repo(repoid)
     repo.repomd_fn = repodata['repomd']
     repo.primary_fn = repodata['primary']
-    repo.filelists_fn = repodata['filelists']
-    sack.load_yum_repo(repo, load_filelists=True)
+    if load_filelists:
+        repo.filelists_fn = repodata['filelists']
+    sack.load_yum_repo(repo, load_filelists=load_filelists,
+                       build_cache=build_cache)
 
 
-def add_repos_to_sack(repo_id, repo_results, sack):
+def add_repos_to_sack(repo_id, repo_results, sack, build_cache=False,
+                      load_filelists=True):
     for arch, repo_result in repo_results.items():
-        add_repo_to_sack('{}-{}'.format(repo_id, arch), repo_result, sack)
+        add_repo_to_sack('{}-{}'.format(repo_id, arch), repo_result, sack,
+                         build_cache=build_cache,
+                         load_filelists=load_filelists)
 
 
-def get_build_group():
-    tag_name = koji_config['build_tag']
+def get_build_group(repos):
+    """
+    Returns names of packages installed by default from build group, read
+    from comps of given repos (dict of librepo results by arch).
+    """
     group_name = dep_config['build_group']
-    session = create_koji_session(anonymous=True)
-    groups = session.getTagGroups(tag_name)
-    [packages] = [group['packagelist'] for group in groups if group['name'] == group_name]
-    return [package['package'] for package in packages
-            if not package['blocked'] and package['type'] == 'default']
+    comps_paths = [repo_result.yum_repo['group'] for repo_result
+                   in repos.values() if repo_result.yum_repo.get('group')]
+    if not comps_paths:
+        raise IOError("Repo has no comps")
+    # comps are generated from the build tag and same for all arches
+    comps = ElementTree.parse(comps_paths[0])
+    [group] = [group for group in comps.iter('group')
+               if group.findtext('id') == group_name]
+    return [req.text for req in group.iter('packagereq')
+            if req.get('type', 'mandatory') in ('mandatory', 'default')]
 
 
 def get_koji_packages(package_names):
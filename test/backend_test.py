@@ -129,3 +129,19 @@ class BackendTest(DBTest):
             self.assertEqual('ok', package.state_string)
             event.assert_called_once_with(package, 'failing', 'ok')
             event().dispatch.assert_called_once_with()
+
+    @postgres_only
+    def test_update_state_priorities(self):
+        self.koji_session.getTaskInfo = Mock(return_value=rnv_task)
+        self.koji_session.getTaskChildren = Mock(return_value=rnv_subtasks)
+        package = self.prepare_packages(['rnv'])[0]
+        self.prepare_builds(rnv=True)
+        running_build = self.prepare_builds(rnv=None)[0]
+        running_build.task_id = rnv_task['id']
+        self.s.commit()
+        with patch('koschei.backend.PackageStateUpdateEvent'):
+            self.backend.update_build_state(running_build, 'FAILED')
+        self.assertEqual(200, package.failed_priority)
+        self.assertLess(0, package.time_priority)
+        self.assertEqual(package.failed_priority + package.time_priority,
+                         package.current_priority)
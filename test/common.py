@@ -4,6 +4,7 @@ import sqlalchemy
 import logging
 import shutil
 import json
+import contextlib
 
 from datetime import datetime
 
@@ -44,6 +45,13 @@ workdir = '.workdir'
 def postgres_only(fn):
     return unittest.skipIf(not use_postgres, "Requires postgres")(fn)
 
+def mock_use_repos(repo_mock):
+    """ Makes use_repos of RepoCache mock provide what its get_repos returns """
+    @contextlib.contextmanager
+    def use_repos(repo_id):
+        yield repo_mock.get_repos(repo_id)
+    repo_mock.use_repos.side_effect = use_repos
+
 class AbstractTest(unittest.TestCase):
 
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,34 @@
+from common import DBTest, postgres_only
+
+from koschei import models as m
+
+
+class BulkInsertTest(DBTest):
+    def test_copy_format(self):
+        rows = [(None, 1, u'a\tb'), ('c\\d\ne', True, '')]
+        lines = ('\t'.join(m._copy_value(value) for value in row) + '\n'
+                 for row in rows)
+        stream = m._CopyStream(lines)
+        self.assertEqual('\\N\t1\ta\\tb\n', stream.read(10))
+        self.assertEqual('c\\\\d\\ne\tTrue\t\n', stream.read())
+        self.assertEqual('', stream.read(10))
+
+    def insert_problems(self):
+        pkg, _ = self.prepare_basic_data()
+        problems = [{'package_id': pkg.id, 'problem': 'Problem\t{}'.format(i)}
+                    for i in range(1000)]
+        m.bulk_insert(self.s, m.ResolutionProblem.__table__,
+                      iter(problems))
+        self.s.commit()
+        actual = self.s.query(m.ResolutionProblem.package_id,
+                              m.ResolutionProblem.problem).all()
+        self.assertItemsEqual([(p['package_id'], p['problem'])
+                               for p in problems], actual)
+
+    def test_executemany(self):
+        self.insert_problems()
+
+    @postgres_only
+    def test_copy(self):
+        self.assertEqual('postgresql', self.s.bind.dialect.name)
+        self.insert_problems()
@@ -1,4 +1,5 @@
 import os
+import errno
 import librepo
 import contextlib
 
@@ -9,14 +10,15 @@ from common import AbstractTest
 from koschei import repo_cache
 
 class MockRepo(object):
-    pass
+    yum_repomd = {}
 
 @contextlib.contextmanager
 def librepo_mock():
     mock = Mock()
     with patch('librepo.Handle', return_value=mock):
         mock.perform.return_value = MockRepo
-        for prop in 'destdir', 'repotype', 'urls', 'yumdlist', 'local':
+        for prop in ('destdir', 'repotype', 'urls', 'yumdlist', 'local',
+                     'checksum'):
             prop_mock = PropertyMock()
             setattr(type(mock), prop, prop_mock)
             setattr(mock, 'mock_' + prop, prop_mock)
@@ -33,6 +35,13 @@ def repodirs(repos):
     for repo, arch in repoids(repos):
         yield os.path.join('.', str(repo), arch)
 
+def tmpdirs(repo):
+    for arch in arches:
+        yield os.path.join('.', '.{}.{}.tmp'.format(repo, os.getpid()), arch)
+
+def listdir():
+    return set(os.listdir('.')) - {repo_cache.LOCK_DIR}
+
 def repourls(repos):
     for repo, arch in repoids(repos):
         yield 'http://example.com/{repo}/{arch}'.format(repo=repo, arch=arch)
@@ -42,27 +51,35 @@ class RepoCacheTest(AbstractTest):
         super(RepoCacheTest, self).setUp()
         repos = [7, 123, 666, 1024]
         for repo in repodirs(repos):
-            os.makedirs(repo)
+            os.makedirs(os.path.join(repo, 'repodata'))
+            with open(os.path.join(repo, 'repodata', 'repomd.xml'), 'w'):
+                pass
         os.mkdir('not-repo')
 
     def test_read_from_disk(self):
         with librepo_mock() as mock:
-            repo_cache.RepoCache()
-            repos = 7, 123, 666, 1024
-            mock.mock_local.assert_has_calls([call(True)] * 4)
-            mock.mock_repotype.assert_has_calls([call(librepo.LR_YUMREPO)] * 4)
-            mock.mock_yumdlist.assert_has_calls([call(['primary', 'filelists', 'group'])] * 4)
+            cache = repo_cache.RepoCache()
+            self.assertFalse(mock.perform.called)
+            for repo in 123, 666, 1024:
+                cache.get_repos(repo)
+            repos = 123, 666, 1024
+            mock.mock_local.assert_has_calls([call(True)] * 6)
+            mock.mock_checksum.assert_has_calls([call(True)] * 6)
+            mock.mock_repotype.assert_has_calls([call(librepo.LR_YUMREPO)] * 6)
+            mock.mock_yumdlist.assert_has_calls([call(['primary', 'filelists', 'group'])] * 6)
             mock.mock_urls.assert_has_calls([call([p]) for p in repodirs(repos)])
-            self.assertEqual(8, mock.perform.call_count)
+            self.assertEqual(6, mock.perform.call_count)
 
     def test_lru_init(self):
         with librepo_mock():
             repo_cache.RepoCache()
-            self.assertEqual({'123', '666', '1024', 'not-repo'}, set(os.listdir('.')))
+            self.assertEqual({'123', '666', '1024', 'not-repo'}, listdir())
 
     def test_get_cached(self):
         with librepo_mock() as mock:
             cache = repo_cache.RepoCache()
+            self.assertEqual({'x86_64': MockRepo, 'i386': MockRepo},
+                             cache.get_repos(666))
             mock.reset_mock()
             self.assertEqual({'x86_64': MockRepo, 'i386': MockRepo},
                              cache.get_repos(666))
@@ -75,20 +92,230 @@ class RepoCacheTest(AbstractTest):
             self.assertEqual(MockRepo, cache.get_repo(2000, 'i386'))
             mock.mock_repotype.assert_has_calls([call(librepo.LR_YUMREPO)] * 2)
             mock.mock_yumdlist.assert_has_calls([call(['primary', 'filelists', 'group'])] * 2)
-            mock.mock_urls.assert_has_calls([call([p]) for p in repourls([2000])])
-            mock.mock_destdir.assert_has_calls([call(p) for p in repodirs([2000])])
-            self.assertEqual({'2000', '666', '1024', 'not-repo'}, set(os.listdir('.')))
+            mock.mock_urls.assert_has_calls([call([p]) for p in repourls([2000])],
+                                            any_order=True)
+            mock.mock_destdir.assert_has_calls([call(p) for p in tmpdirs(2000)],
+                                               any_order=True)
+            # loaded from final location after download
+            mock.mock_urls.assert_has_calls([call([p]) for p in repodirs([2000])])
+            self.assertEqual(4, mock.perform.call_count)
+            self.assertEqual({'2000', '666', '1024', 'not-repo'}, listdir())
+
+    def test_download_unavailable(self):
+        with librepo_mock() as mock:
+            cache = repo_cache.RepoCache()
+            mock.perform.side_effect = librepo.LibrepoException(
+                repo_cache.REPO_404, 'Not found', 'Not found')
+            self.assertIsNone(cache.get_repo(2000, 'i386'))
+            self.assertEqual({'123', '666', '1024', 'not-repo'},
+                             listdir())
+
+    def test_download_partial_failure(self):
+        with librepo_mock() as mock:
+            cache = repo_cache.RepoCache()
+            mock.perform.side_effect = [
+                MockRepo, librepo.LibrepoException(1, 'Error', 'Error')]
+            self.assertRaises(librepo.LibrepoException, cache.get_repo,
+                              2000, 'i386')
+            self.assertEqual({'123', '666', '1024', 'not-repo'},
+                             listdir())
+            self.assertNotIn(2000, cache._cache)
+
+    def test_download_other_failure(self):
+        with librepo_mock() as mock:
+            cache = repo_cache.RepoCache()
+            mock.perform.side_effect = [MockRepo, OSError()]
+            self.assertRaises(OSError, cache.get_repo, 2000, 'i386')
+            self.assertEqual({'123', '666', '1024', 'not-repo'},
+                             listdir())
+
+    def test_tmp_cleanup(self):
+        os.makedirs(os.path.join('.2000.tmp', 'x86_64'))
+        with librepo_mock():
+            repo_cache.RepoCache()
+            self.assertNotIn('.2000.tmp', listdir())
 
     def test_lru_basic(self):
         with librepo_mock():
             cache = repo_cache.RepoCache()
             cache.get_repo(123, 'x86_64')
             cache.get_repo(2000, 'i386')
-            self.assertEqual({'2000', '123', '1024', 'not-repo'}, set(os.listdir('.')))
+            self.assertEqual({'2000', '123', '1024', 'not-repo'}, listdir())
 
     def test_lru_more(self):
         with librepo_mock():
             cache = repo_cache.RepoCache()
             for repo in 5555, 666, 1024, 2000, 123, 7:
                 cache.get_repo(repo, 'x86_64')
-            self.assertEqual({'2000', '123', '7', 'not-repo'}, set(os.listdir('.')))
+            self.assertEqual({'2000', '123', '7', 'not-repo'}, listdir())
+
+    def test_cache_dir_evicted(self):
+        with librepo_mock():
+            cache = repo_cache.RepoCache()
+            cache_dir = cache.get_cache_dir(666)
+            self.assertEqual(os.path.join('.', '666', 'cache'), cache_dir)
+            os.mkdir(cache_dir)
+            for repo in 2000, 2001:
+                cache.get_repo(repo, 'x86_64')
+            self.assertFalse(os.path.exists(cache_dir))
+
+    def test_prefetch(self):
+        with librepo_mock() as mock:
+            cache = repo_cache.RepoCache()
+            mock.reset_mock()
+            cache.prefetch(666)
+            cache.prefetch(2000)
+            cache.prefetch(2000)
+            self.assertEqual(MockRepo, cache.get_repo(2000, 'i386'))
+            self.assertEqual(MockRepo, cache.get_repo(666, 'i386'))
+            # 666 loaded from disk, 2000 downloaded and loaded once
+            self.assertEqual(6, mock.perform.call_count)
+            self.assertEqual({'2000', '666', '1024', 'not-repo'}, listdir())
+
+    def test_join_prefetching(self):
+        with librepo_mock():
+            cache = repo_cache.RepoCache()
+            cache.prefetch(2000)
+            cache.join_prefetching()
+            self.assertFalse(cache._prefetching)
+            self.assertIn(2000, cache._cache)
+
+    def test_in_use_not_evicted(self):
+        with librepo_mock():
+            cache = repo_cache.RepoCache()
+            with cache.use_repos(666) as repos:
+                self.assertEqual(MockRepo, repos['i386'])
+                # evicts the least recently used repos, 666 is the oldest
+                for repo in 2000, 2001, 2002:
+                    cache.get_repo(repo, 'x86_64')
+                self.assertIn('666', listdir())
+                self.assertIn(666, cache._cache)
+            self.assertFalse(cache._in_use)
+
+    def test_prefetch_failure(self):
+        with librepo_mock() as mock:
+            cache = repo_cache.RepoCache()
+            # both arches fail in background, then are downloaded again
+            mock.perform.side_effect = [IOError(), IOError()] + [MockRepo] * 4
+            cache.prefetch(2000)
+            self.assertEqual(MockRepo, cache.get_repo(2000, 'i386'))
+            self.assertFalse([name for name in listdir()
+                              if name.endswith('.tmp')])
+
+    def test_dedup(self):
+        repomds = {
+            'http://example.com/2000/x86_64': {
+                'primary': {'checksum': 'p1',
+                            'location_href': 'repodata/p1-primary.xml.gz'},
+                'filelists': {'checksum': 'f1',
+                              'location_href': 'repodata/f1-filelists.xml.gz'},
+            },
+            'http://example.com/2001/x86_64': {
+                'primary': {'checksum': 'p1',
+                            'location_href': 'repodata/p1-primary.xml.gz'},
+                'filelists': {'checksum': 'f2',
+                              'location_href': 'repodata/f2-filelists.xml.gz'},
+                'revision': '2001',
+            },
+        }
+        with librepo_mock() as mock:
+            def perform(result):
+                [url] = mock.mock_urls.call_args[0][0]
+                if url.startswith('http'):
+                    destdir = mock.mock_destdir.call_args[0][0]
+                    repomd = repomds[url]
+                    if not os.path.exists(os.path.join(destdir, 'repodata')):
+                        os.mkdir(os.path.join(destdir, 'repodata'))
+                    for name in mock.mock_yumdlist.call_args[0][0]:
+                        path = os.path.join(destdir,
+                                            repomd[name]['location_href'])
+                        with open(path, 'w') as md_file:
+                            md_file.write(name)
+                    result.yum_repomd = repomd
+                return result
+            mock.perform.side_effect = perform
+            with patch('librepo.Result', Mock):
+                cache = repo_cache.RepoCache(koji_repos={
+                    'x86_64': 'http://example.com/{repo_id}/x86_64'})
+                mock.reset_mock()
+                cache.get_repos(2000)
+                cache.get_repos(2001)
+        mock.mock_yumdlist.assert_has_calls([call([]),
+                                             call(['filelists'])])
+        self.assertEqual({'p1', 'f1', 'f2'}, set(os.listdir('objects')))
+        inodes = {os.stat(os.path.join(str(repo_id), 'x86_64', 'repodata',
+                                       'p1-primary.xml.gz')).st_ino
+                  for repo_id in (2000, 2001)}
+        self.assertEqual({os.stat(os.path.join('objects', 'p1')).st_ino},
+                         inodes)
+
+    def test_collect_garbage(self):
+        os.mkdir('objects')
+        for name in 'used', 'unused':
+            with open(os.path.join('objects', name), 'w'):
+                pass
+        os.link(os.path.join('objects', 'used'),
+                os.path.join('666', 'x86_64', 'used'))
+        with librepo_mock():
+            repo_cache.RepoCache()
+        self.assertEqual(['used'], os.listdir('objects'))
+
+    def test_collect_garbage_concurrent(self):
+        with librepo_mock():
+            cache = repo_cache.RepoCache()
+        os.mkdir('objects')
+        with open(os.path.join('objects', 'removed'), 'w'):
+            pass
+        # removed by other process after listing
+        with patch('os.stat', side_effect=OSError(errno.ENOENT, 'Removed')):
+            cache._collect_garbage()
+
+    def test_quarantine_incomplete(self):
+        os.unlink(os.path.join('666', 'i386', 'repodata', 'repomd.xml'))
+        with librepo_mock() as mock:
+            cache = repo_cache.RepoCache()
+            self.assertEqual({'7', '123', '1024', '.666.corrupt', 'not-repo'},
+                             listdir())
+            self.assertEqual(MockRepo, cache.get_repo(666, 'i386'))
+            mock.mock_urls.assert_has_calls([call([p]) for p in repourls([666])],
+                                            any_order=True)
+            self.assertIn('666', listdir())
+
+    def test_quarantine_corrupt(self):
+        with librepo_mock() as mock:
+            cache = repo_cache.RepoCache()
+            mock.perform.side_effect = \
+                [librepo.LibrepoException(1, 'Bad checksum', 'Bad checksum')] + \
+                [MockRepo] * 4
+            self.assertEqual(MockRepo, cache.get_repo(666, 'i386'))
+            self.assertEqual(5, mock.perform.call_count)
+            self.assertEqual({'123', '666', '1024', '.666.corrupt', 'not-repo'},
+                             listdir())
+
+    def test_quarantine_locked(self):
+        with librepo_mock():
+            cache1 = repo_cache.RepoCache()
+            cache1.get_repos(666)
+            os.unlink(os.path.join('666', 'i386', 'repodata', 'repomd.xml'))
+            # used by other process, cannot be moved away
+            repo_cache.RepoCache()
+            self.assertEqual({'123', '666', '1024', 'not-repo'}, listdir())
+
+    def test_shared(self):
+        with librepo_mock() as mock:
+            cache1 = repo_cache.RepoCache()
+            cache1.get_repos(123)
+            cache1.get_repos(2000)
+            cache2 = repo_cache.RepoCache()
+            mock.reset_mock()
+            # downloaded by other process
+            cache2.get_repos(2000)
+            mock.mock_urls.assert_has_calls([call([p]) for p in repodirs([2000])])
+            self.assertEqual(2, mock.perform.call_count)
+            cache2.get_repos(1024)
+            # 123 and 2000 are used less recently, but locked by cache1
+            cache2.get_repos(3000)
+            self.assertEqual({'123', '2000', '3000', 'not-repo'}, listdir())
+            mock.reset_mock()
+            cache1.get_repos(123)
+            self.assertFalse(mock.perform.called)
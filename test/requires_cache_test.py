@@ -0,0 +1,85 @@
+import hawkey
+
+from mock import Mock
+from common import AbstractTest
+
+from koschei.requires_cache import RequiresCache, format_reldep
+
+FOO_RPM = {'id': 1, 'build_id': 10, 'name': 'foo', 'epoch': None,
+           'version': '4', 'release': '1.fc22', 'arch': 'src'}
+FOO_DEPS = [
+    {'name': 'A', 'version': '', 'flags': 0, 'type': 0},
+    {'name': 'B', 'version': '4', 'flags': 12, 'type': 0},
+    {'name': 'C', 'version': '1:3', 'flags': 10, 'type': 0},
+    {'name': 'rpmlib(CompressedFileNames)', 'version': '3.0.4-1',
+     'flags': 16777226, 'type': 0},
+]
+FOO_NEVR = ('foo', None, '4', '1.fc22')
+
+
+class RequiresCacheTest(AbstractTest):
+    def get_cache(self, koji_session=None, keep=2):
+        return RequiresCache(koji_session, cache_dir='.', keep=keep)
+
+    def prepare_foo(self):
+        koji_mock = Mock()
+        koji_mock.multiCall.side_effect = [[[[FOO_RPM]]], [[FOO_DEPS]]]
+        cache = self.get_cache(koji_mock)
+        cache.get_latest_srpms([{'build_id': 10}])
+        koji_mock.getRPMDeps.assert_called_once_with(1, 0)
+        return cache
+
+    def test_format_reldep(self):
+        self.assertEqual(['A', 'B >= 4', 'C <= 1:3'],
+                         [format_reldep(dep) for dep in FOO_DEPS[:3]])
+
+    def test_fetch(self):
+        self.prepare_foo()
+        cache = self.get_cache()
+        self.assertEqual(FOO_NEVR, cache.get_srpm(*FOO_NEVR))
+        self.assertIsNone(cache.get_repodata())
+
+    def test_get_srpm(self):
+        koji_mock = Mock()
+        koji_mock.multiCall.side_effect = [[[FOO_RPM]], [[FOO_DEPS]]]
+        cache = self.get_cache(koji_mock)
+        self.assertEqual(FOO_NEVR, cache.get_srpm(*FOO_NEVR))
+        koji_mock.getRPM.assert_called_once_with('foo-4-1.fc22.src')
+
+    def test_index(self):
+        index = self.prepare_foo().get_index(hawkey.Sack())
+        foo = index.get('foo')
+        self.assertEqual('4-1.fc22', foo.evr)
+        self.assertEqual(['A', 'B >= 4', 'C <= 1:3'],
+                         [str(reldep) for reldep in foo.requires])
+        self.assertIs(foo, index.get('foo', (0, '4', '1.fc22')))
+        self.assertIsNone(index.get('foo', (0, '3', '1.fc22')))
+        self.assertIsNone(index.get('bar'))
+        self.assertEqual({'foo'}, index.get_requiring(['B = 5', 'D']))
+
+    def test_evict(self):
+        cache = self.prepare_foo()
+        old = dict(FOO_RPM, id=2, version='3')
+        cache._koji_session.multiCall.side_effect = [[[[old]]], [[FOO_DEPS]]]
+        cache.get_latest_srpms([{'build_id': 9}])
+        cache.evict()
+        self.assertIsNotNone(cache.get_index(hawkey.Sack())
+                             .get('foo', (None, '3', '1.fc22')))
+        cache._keep = 1
+        cache.evict()
+        self.assertIsNone(self.get_cache().get_index(hawkey.Sack())
+                          .get('foo', (None, '3', '1.fc22')))
+
+    def test_index_follows_cache(self):
+        cache = self.prepare_foo()
+        index = cache.get_index(hawkey.Sack())
+        foo = index.get('foo')
+        old = dict(FOO_RPM, id=2, version='3')
+        cache._koji_session.multiCall.side_effect = [[[[old]]], [[FOO_DEPS]]]
+        cache.get_latest_srpms([{'build_id': 9}])
+        self.assertIsNotNone(index.get('foo', (None, '3', '1.fc22')))
+        self.assertIs(foo, index.get('foo'))
+        cache._keep = 1
+        cache.evict()
+        self.assertIsNone(index.get('foo', (None, '3', '1.fc22')))
+        self.assertIs(foo, index.get('foo'))
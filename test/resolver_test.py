@@ -18,11 +18,18 @@
 
 import os
 import shutil
+import contextlib
+import hawkey
 import librepo
-from common import DBTest, testdir, postgres_only
-from mock import Mock, patch
-from koschei.models import Dependency, DependencyChange, Package, ResolutionProblem
-from koschei.resolver import Resolver, GenerateRepoTask, ProcessBuildsTask
+from common import (DBTest, testdir, datadir, postgres_only,
+                    mock_use_repos)
+from mock import Mock, patch, call
+from koschei import util, resolver
+from koschei.models import (Dependency, DependencyChange, Package,
+                            ResolutionProblem, RepoGenerationRequest)
+from koschei.resolver import (Resolver, GenerateRepoTask, ProcessBuildsTask,
+                              GenerationState, DependencyGraph)
+from koschei.requires_cache import RequiresCache
 
 FOO_DEPS = [
     ('A', 0, '1', '1.fc22', 'x86_64'),
@@ -55,6 +62,8 @@ class ResolverTest(DBTest):
         shutil.copytree(os.path.join(testdir, 'test_repo'), 'repo')
         self.repo_mock = Mock()
         self.repo_mock.get_repos.return_value = {'x86_64': get_repo('x86_64')}
+        mock_use_repos(self.repo_mock)
+        self.repo_mock.get_cache_dir.return_value = 'cache'
         self.srpm_mock = Mock()
         self.srpm_mock.get_repodata.return_value = get_repo('src')
         self.resolver = Resolver(db=self.s, koji_session=Mock(),
@@ -90,9 +99,12 @@ class ResolverTest(DBTest):
         package_id = foo_build.package_id
         with patch('koschei.util.get_build_group', return_value=['R']):
             self.resolver.create_task(ProcessBuildsTask).run()
-        self.repo_mock.get_repos.assert_called_once_with(666)
-        self.srpm_mock.get_srpm.assert_called_once_with('foo', None, '4', '1.fc22')
-        self.srpm_mock.get_repodata.assert_called_once_with()
+        # for the sack and for the build group
+        self.assertEqual([call(666)] * 2,
+                         self.repo_mock.get_repos.call_args_list)
+        self.srpm_mock.get_srpms.assert_called_once_with([('foo', None, '4', '1.fc22')])
+        self.srpm_mock.get_repodata.assert_called_once_with(
+            view='builds', nevrs=[('foo', None, '4', '1.fc22')])
         expected_deps = [tuple([package_id, 666] + list(nevr)) for nevr in FOO_DEPS]
         actual_deps = self.s.query(Dependency.package_id, Dependency.repo_id,
                                    Dependency.name, Dependency.epoch,
@@ -159,12 +171,340 @@ class ResolverTest(DBTest):
         self.s.expire_all()
         foo = self.s.query(Package).filter_by(name='foo').first()
         bar = self.s.query(Package).filter_by(name='bar').first()
-        self.repo_mock.get_repos.assert_called_once_with(666)
-        self.srpm_mock.get_repodata.assert_called_once_with()
+        # for the sack and for the build group
+        self.assertEqual([call(666)] * 2,
+                         self.repo_mock.get_repos.call_args_list)
+        [(_, kwargs)] = self.srpm_mock.get_repodata.call_args_list
+        self.assertEqual('latest', kwargs['view'])
+        self.assertItemsEqual(['foo', 'bar'], kwargs['names'])
         self.verify_changes()
+        self.assertEqual(20, foo.dependency_priority)
         self.assertTrue(foo.resolved)
         self.assertFalse(self.s.query(ResolutionProblem)
                          .filter_by(package_id=foo.id).count())
         self.assertFalse(bar.resolved)
         self.assertTrue(self.s.query(ResolutionProblem)
                         .filter_by(package_id=bar.id).count())
+
+    def generate_changes(self, workers, filelists_on_demand=False):
+        with patch.dict(util.config['dependency'], resolution_workers=workers,
+                        filelists_on_demand=filelists_on_demand):
+            task = self.resolver.create_task(GenerateRepoTask)
+            task.prepare_sack(666, get_repo('src'))
+            task.group = ['R']
+            changes = task.generate_dependency_changes(task.get_packages(), 666)
+        return changes, task.resolved_packages, task.problems
+
+    def test_parallel_resolution(self):
+        self.prepare_old_build()
+        self.prepare_packages(['bar'])
+        changes, resolved, problems = self.generate_changes(workers=1)
+        self.assertEqual(2, len(changes))
+        self.assertEqual(2, len(resolved))
+        p_changes, p_resolved, p_problems = self.generate_changes(workers=2)
+        self.assertItemsEqual(changes, p_changes)
+        self.assertEqual(resolved, p_resolved)
+        self.assertItemsEqual(problems, p_problems)
+
+    def test_workers_stopped(self):
+        self.prepare_old_build()
+        with patch('multiprocessing.Pool') as pool_mock:
+            pool_mock.return_value.imap.side_effect = RuntimeError()
+            self.assertRaises(RuntimeError, self.generate_changes, workers=2)
+        self.assertTrue(self.repo_mock.join_prefetching.called)
+        pool_mock.assert_called_once_with(2)
+        self.assertTrue(pool_mock.return_value.terminate.called)
+        self.assertTrue(pool_mock.return_value.join.called)
+        self.assertIsNone(resolver._worker_task)
+
+    def test_filelists_on_demand(self):
+        self.prepare_old_build()
+        self.prepare_packages(['bar'])
+        changes, resolved, problems = self.generate_changes(workers=1)
+        for workers in 1, 2:
+            o_changes, o_resolved, o_problems = \
+                self.generate_changes(workers, filelists_on_demand=True)
+            self.assertItemsEqual(changes, o_changes)
+            self.assertEqual(resolved, o_resolved)
+            self.assertItemsEqual(problems, o_problems)
+
+    def test_filelists_fallback(self):
+        requires_cache = RequiresCache(None, cache_dir='.')
+        # file not listed in primary
+        requires_cache._requires[('foo', None, '4', '1.fc22')] = \
+            'A\n/usr/share/doc/B/bla'
+        resolver = Resolver(db=self.s, koji_session=Mock(),
+                            repo_cache=self.repo_mock,
+                            srpm_cache=requires_cache)
+        with patch.dict(util.config['dependency'], filelists_on_demand=True):
+            task = resolver.create_task(GenerateRepoTask)
+        task.prepare_sack(666, None)
+        task.group = ['R']
+        srpm = task.get_srpm_pkg('foo')
+        self.assertIsNone(task.resolve_in_sack(srpm))
+        resolved, problems, deps = task.resolve_requires(srpm)
+        self.assertTrue(resolved)
+        self.assertIn('B', [dep.name for dep in deps])
+        self.assertEqual({'foo'}, task.filelists_names)
+        # sack without filelists is used again for other packages
+        self.assertFalse(task.has_filelists)
+        self.assertIs(srpm, task.get_srpm_pkg('foo'))
+
+    def test_affected_packages(self):
+        old_build = self.prepare_old_build()
+        self.prepare_packages(['bar'])
+        foo, bar = self.s.query(Package).order_by(Package.name.desc()).all()
+        foo.resolved = True
+        self.s.commit()
+        task = self.resolver.create_task(GenerateRepoTask)
+        packages = task.get_packages()
+        state = GenerationState(666, {}, {foo.id: '4-1.fc22'},
+                                {foo.id: old_build.id, bar.id: None})
+        affected = lambda touched, touched_srpms=(): \
+            [p.name for p in task.get_affected_packages(packages, state, state,
+                                                        touched, touched_srpms)]
+        self.assertEqual(['bar'], affected({'Z'}))
+        self.assertItemsEqual(['foo', 'bar'], affected({'C'}))
+        self.assertItemsEqual(['foo', 'bar'], affected(set(), {'foo'}))
+        state.filelists_names = {'foo'}
+        self.assertItemsEqual(['foo', 'bar'], affected(set()))
+        new_state = GenerationState(667, {}, {foo.id: '5-1.fc22'},
+                                    state.comparison_builds)
+        self.assertItemsEqual(['foo', 'bar'],
+                              [p.name for p in task.get_affected_packages(
+                                  packages, state, new_state, set(), ())])
+
+    def test_resolve_incrementally(self):
+        task = self.resolver.create_task(GenerateRepoTask)
+        state = GenerationState(666, {}, {}, {}, ['R'])
+        same_group = GenerationState(667, {}, {}, {}, ['R'])
+        new_group = GenerationState(667, {}, {}, {}, ['R', 'bash'])
+        incremental = task.can_resolve_incrementally
+        with patch.dict(util.config['dependency'], incremental_resolution=True):
+            self.assertTrue(incremental(state, same_group, 666))
+            self.assertFalse(incremental(state, new_group, 666))
+            self.assertFalse(incremental(state, same_group, 665))
+            self.assertFalse(incremental(None, same_group, 666))
+
+    def test_group_base(self):
+        task = self.resolver.create_task(GenerateRepoTask)
+        task.prepare_sack(666, get_repo('src'))
+        nevra = lambda pkg: (pkg.name, pkg.epoch, pkg.version, pkg.release,
+                             pkg.arch)
+        for group in ['R'], ['B'], ['F', 'R'], ['A', 'E']:
+            task.group = group
+            task.group_base = None
+            self.assertLessEqual(set(group), {pkg.name for pkg
+                                              in task.get_group_base()[0]})
+            for srpm in hawkey.Query(task.sack).filter(arch='src'):
+                # the same as resolution with build group selected by names
+                goal, problems = task.prepare_goal(srpm)
+                expected = None
+                if not problems and goal.run():
+                    expected = sorted(nevra(pkg) for pkg in goal.list_installs()
+                                      if pkg.arch != 'src')
+                resolved, _, deps = task.resolve_in_sack(srpm)
+                self.assertEqual(expected is not None, resolved)
+                self.assertEqual(expected, deps and sorted(nevra(dep)
+                                                           for dep in deps))
+
+    def test_dependency_graph(self):
+        task = self.resolver.create_task(GenerateRepoTask)
+        task.prepare_sack(666, get_repo('src'))
+        graph = DependencyGraph(task.sack)
+        srpm = task.get_srpm_pkg('foo')
+        distances = graph.get_distances(srpm.requires, ['C', 'E', 'nonexistent'])
+        self.assertEqual(2, distances['C'])
+        self.assertEqual(2, distances['E'])
+        self.assertNotIn('nonexistent', distances)
+        self.assertEqual(distances, graph.get_distances(srpm.requires,
+                                                        ['C', 'E', 'nonexistent']))
+
+    def test_dependency_graph_levels(self):
+        def bfs_distances(sack, reldeps, names, max_level):
+            # the original level by level search with provides queries
+            distances = {}
+            visited = set()
+            level = 1
+            while level <= max_level and reldeps:
+                pkgs_on_level = set(hawkey.Query(sack)
+                                    .filter(provides=list(reldeps)))
+                reldeps = {req for pkg in pkgs_on_level if pkg not in visited
+                           for req in pkg.requires}
+                visited.update(pkgs_on_level)
+                for pkg in pkgs_on_level:
+                    if pkg.name in names and pkg.name not in distances:
+                        distances[pkg.name] = level
+                level += 1
+            return distances
+
+        task = self.resolver.create_task(GenerateRepoTask)
+        task.prepare_sack(666, get_repo('src'))
+        pkgs = list(hawkey.Query(task.sack))
+        names = {pkg.name for pkg in pkgs}
+        starts = [pkg.requires for pkg in pkgs] + \
+            [[hawkey.Reldep(task.sack, 'E')]]
+        for max_level in 4, 2:
+            with patch('koschei.resolver.MAX_DISTANCE', max_level):
+                graph = DependencyGraph(task.sack)
+                for reldeps in starts:
+                    self.assertEqual(bfs_distances(task.sack, reldeps, names,
+                                                   max_level),
+                                     graph.get_distances(reldeps, names))
+        # B and C are four levels away from E
+        self.assertEqual(4, graph.get_distances([hawkey.Reldep(task.sack,
+                                                               'E')],
+                                                ['C'])['C'])
+
+    def test_comparison_deps(self):
+        old_build = self.prepare_old_build()
+        self.prepare_packages(['bar'])
+        task = self.resolver.create_task(GenerateRepoTask)
+        [(package_id, deps)] = list(task.get_comparison_deps())
+        self.assertEqual(old_build.package_id, package_id)
+        self.assertEqual(6, len(deps))
+        self.assertEqual({old_build.package_id: old_build.id},
+                         dict(task.get_comparison_build_query().all()))
+
+    def test_dependency_users(self):
+        old_build = self.prepare_old_build()
+        package_id = old_build.package_id
+        # left over from a repo no build is compared against anymore
+        self.s.add(Dependency(package_id=package_id, repo_id=444, arch='noarch',
+                              name='Z', epoch=0, version='1', release='1'))
+        self.s.commit()
+        task = self.resolver.create_task(GenerateRepoTask)
+        self.assertEqual({package_id}, task.get_dependency_users({'C', 'Z'}))
+        self.assertEqual(set(), task.get_dependency_users({'Z'}))
+
+    def test_update_resolution_problems(self):
+        foo, bar = self.prepare_packages(['foo', 'bar'])
+        for pkg, problem in (foo, 'A'), (foo, 'B'), (bar, 'C'):
+            self.s.add(ResolutionProblem(package_id=pkg.id, problem=problem))
+        self.s.commit()
+        kept_id = self.s.query(ResolutionProblem.id).filter_by(problem='A')\
+                        .scalar()
+        task = self.resolver.create_task(GenerateRepoTask)
+        task.record_resolution(foo.id, False, ['A', 'D'])
+        task.record_resolution(bar.id, True, [])
+        task.update_resolution_problems()
+        self.s.commit()
+        problems = self.s.query(ResolutionProblem.package_id,
+                                ResolutionProblem.problem).all()
+        self.assertItemsEqual([(foo.id, 'A'), (foo.id, 'D')], problems)
+        self.assertEqual(kept_id, self.s.query(ResolutionProblem.id)
+                         .filter_by(problem='A').scalar())
+
+    def test_synchronize_resolution_state(self):
+        foo, bar = self.prepare_packages(['foo', 'bar'])
+        foo.resolved = True
+        bar.resolved = True
+        self.s.commit()
+        task = self.resolver.create_task(GenerateRepoTask)
+        task.record_resolution(foo.id, True, [])
+        task.record_resolution(bar.id, False, ['X'])
+        with patch('koschei.resolver.check_package_state') as check_mock:
+            task.synchronize_resolution_state()
+        self.s.commit()
+        check_mock.assert_called_once_with(bar, 'ignored')
+        self.assertTrue(foo.resolved)
+        self.assertFalse(bar.resolved)
+
+    def test_evict_srpms(self):
+        self.prepare_foo_build()
+        processed = self.prepare_foo_build(version='3')
+        processed.deps_processed = True
+        self.s.commit()
+        self.resolver.create_task(GenerateRepoTask).evict_srpms()
+        self.srpm_mock.evict.assert_called_once_with(
+            {('foo', None, '4', '1.fc22')}, tracked={'foo'})
+
+    def test_koji_requires(self):
+        task = self.resolver.create_task(GenerateRepoTask)
+        task.prepare_sack(666, get_repo('src'))
+        requires = '\n'.join(str(reldep) for reldep
+                             in task.get_srpm_pkg('foo').requires)
+        requires_cache = RequiresCache(None, cache_dir='.')
+        requires_cache._requires[('foo', None, '4', '1.fc22')] = requires
+        resolver = Resolver(db=self.s, koji_session=Mock(),
+                            repo_cache=self.repo_mock,
+                            srpm_cache=requires_cache)
+        task = resolver.create_task(GenerateRepoTask)
+        task.prepare_sack(666, requires_cache.get_repodata())
+        task.group = ['R']
+        srpm = task.get_srpm_pkg('foo')
+        self.assertEqual('4-1.fc22', srpm.evr)
+        resolved, problems, deps = task.resolve_requires(srpm)
+        self.assertTrue(resolved)
+        self.assertItemsEqual(FOO_DEPS, [(dep.name, dep.epoch, dep.version,
+                                          dep.release, dep.arch)
+                                         for dep in deps])
+
+    def test_koji_requires_unresolvable(self):
+        requires_cache = RequiresCache(None, cache_dir='.')
+        requires_cache._requires[('bar', 1, '2', '2')] = 'nonexistent'
+        resolver = Resolver(db=self.s, koji_session=Mock(),
+                            repo_cache=self.repo_mock,
+                            srpm_cache=requires_cache)
+        task = resolver.create_task(GenerateRepoTask)
+        task.prepare_sack(666, requires_cache.get_repodata())
+        task.group = ['R']
+        srpm = task.get_srpm_pkg('bar')
+        resolved, problems, deps = task.resolve_requires(srpm)
+        self.assertFalse(resolved)
+        self.assertEqual(['No package found for: nonexistent'], problems)
+        self.assertIsNone(deps)
+
+    def test_build_group(self):
+        repo = Mock()
+        repo.yum_repo = {'group': os.path.join(datadir, 'comps.xml')}
+        no_comps = Mock()
+        no_comps.yum_repo = {}
+        self.assertEqual(['R', 'bash'],
+                         util.get_build_group({'i386': no_comps,
+                                               'x86_64': repo}))
+        self.assertRaises(IOError, util.get_build_group, {'i386': no_comps})
+
+    def test_build_group_cached(self):
+        task = self.resolver.create_task(GenerateRepoTask)
+        with patch('koschei.util.get_build_group',
+                   return_value=['R']) as group_mock:
+            self.assertEqual(['R'], task.get_build_group(666))
+            self.assertEqual(['R'], self.resolver.create_task(
+                ProcessBuildsTask).get_build_group(666))
+            for repo_id in range(667, 671):
+                task.get_build_group(repo_id)
+            task.get_build_group(666)
+        self.assertEqual(6, group_mock.call_count)
+        self.assertEqual([669, 670, 666], list(self.resolver.build_groups))
+
+    def test_build_group_repo_in_use(self):
+        in_use = []
+        held = []
+
+        @contextlib.contextmanager
+        def use_repos(repo_id):
+            in_use.append(repo_id)
+            yield self.repo_mock.get_repos(repo_id)
+            in_use.remove(repo_id)
+
+        def get_build_group(repos):
+            held.extend(in_use)
+            return ['R']
+        self.repo_mock.use_repos.side_effect = use_repos
+        with patch('koschei.util.get_build_group',
+                   side_effect=get_build_group):
+            self.resolver.create_task(GenerateRepoTask).get_build_group(666)
+        self.assertEqual([666], held)
+        self.assertFalse(in_use)
+
+    def test_prefetch_repos(self):
+        self.prepare_foo_build(repo_id=666)
+        processed = self.prepare_foo_build(repo_id=555)
+        processed.deps_processed = True
+        for repo_id in 667, 668:
+            self.s.add(RepoGenerationRequest(repo_id=repo_id))
+        self.s.commit()
+        self.resolver.prefetch_repos()
+        self.assertEqual([call(668), call(666)],
+                         self.repo_mock.prefetch.call_args_list)
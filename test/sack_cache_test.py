@@ -0,0 +1,101 @@
+import os
+import shutil
+
+from mock import Mock
+from common import AbstractTest, testdir, mock_use_repos
+from resolver_test import get_repo
+
+from koschei.sack_cache import SackCache, get_repodata_size
+
+
+class SackCacheTest(AbstractTest):
+    def setUp(self):
+        super(SackCacheTest, self).setUp()
+        shutil.copytree(os.path.join(testdir, 'test_repo'), 'repo')
+        self.repo_mock = Mock()
+        self.repo_mock.get_repos.return_value = {'x86_64': get_repo('x86_64')}
+        mock_use_repos(self.repo_mock)
+        self.repo_mock.get_cache_dir.side_effect = \
+            lambda repo_id: os.path.join('cache', str(repo_id))
+        self.srpm_repo = get_repo('src')
+
+    def test_cached(self):
+        cache = SackCache(self.repo_mock)
+        sack, srpm_index = cache.get_sack(666, self.srpm_repo)
+        self.assertIsNotNone(sack)
+        self.assertEqual((sack, srpm_index), cache.get_sack(666, self.srpm_repo))
+        self.repo_mock.get_repos.assert_called_once_with(666)
+
+    def test_unavailable(self):
+        self.repo_mock.get_repos.return_value = None
+        cache = SackCache(self.repo_mock)
+        self.assertEqual((None, None), cache.get_sack(666, self.srpm_repo))
+
+    def test_evict(self):
+        size = sum(get_repodata_size(repo, True) for repo
+                   in (get_repo('x86_64'), self.srpm_repo))
+        # room for one sack only
+        cache = SackCache(self.repo_mock, max_size=1.5 * size / 1024 / 1024)
+        sack1, _ = cache.get_sack(1, self.srpm_repo)
+        self.assertEqual(size, cache._sacks.values()[0][3])
+        cache.get_sack(2, self.srpm_repo)
+        self.assertIsNot(sack1, cache.get_sack(1, self.srpm_repo)[0])
+        self.assertEqual(3, self.repo_mock.get_repos.call_count)
+
+    def test_evict_without_filelists(self):
+        size = sum(get_repodata_size(repo, True) for repo
+                   in (get_repo('x86_64'), self.srpm_repo))
+        cache = SackCache(self.repo_mock, max_size=1.5 * size / 1024 / 1024)
+        # sacks without filelists are smaller, both fit
+        sack1, _ = cache.get_sack(1, self.srpm_repo, filelists=False)
+        cache.get_sack(2, self.srpm_repo, filelists=False)
+        self.assertIs(sack1, cache.get_sack(1, self.srpm_repo,
+                                            filelists=False)[0])
+
+    def test_filelists(self):
+        cache = SackCache(self.repo_mock)
+        sack, _ = cache.get_sack(666, self.srpm_repo, filelists=False)
+        full_sack, _ = cache.get_sack(666, self.srpm_repo)
+        self.assertIsNot(sack, full_sack)
+        self.assertIs(sack, cache.get_sack(666, self.srpm_repo,
+                                           filelists=False)[0])
+        self.assertIs(full_sack, cache.get_sack(666, self.srpm_repo)[0])
+        self.assertEqual(2, self.repo_mock.get_repos.call_count)
+
+    def test_views(self):
+        cache = SackCache(self.repo_mock)
+        latest, _ = cache.get_sack(666, self.srpm_repo, view='latest')
+        builds, _ = cache.get_sack(666, get_repo('x86_64'), view='builds')
+        self.assertIsNot(latest, builds)
+        self.assertIs(latest, cache.get_sack(666, self.srpm_repo,
+                                             view='latest')[0])
+        self.assertIs(builds, cache.get_sack(666, get_repo('x86_64'),
+                                             view='builds')[0])
+        self.assertEqual(2, self.repo_mock.get_repos.call_count)
+
+    def test_view_changed(self):
+        cache = SackCache(self.repo_mock)
+        sack, _ = cache.get_sack(666, self.srpm_repo, view='latest')
+        changed, _ = cache.get_sack(666, get_repo('x86_64'), view='latest')
+        self.assertIsNot(sack, changed)
+        self.assertEqual(1, len(cache._sacks))
+
+    def test_external_index(self):
+        cache = SackCache(self.repo_mock)
+        get_index = Mock()
+        sack, srpm_index = cache.get_sack(666, None, get_index=get_index)
+        get_index.assert_called_once_with(sack)
+        self.assertIs(get_index.return_value, srpm_index)
+        self.assertEqual((sack, srpm_index),
+                         cache.get_sack(666, None, get_index=get_index))
+        self.assertEqual(1, get_index.call_count)
+
+    def test_srpm_index(self):
+        cache = SackCache(self.repo_mock)
+        _, srpm_index = cache.get_sack(666, self.srpm_repo)
+        foo = srpm_index.get('foo')
+        self.assertEqual('foo', foo.name)
+        self.assertEqual(foo, srpm_index.get('foo', (foo.epoch, foo.version,
+                                                     foo.release)))
+        self.assertIsNone(srpm_index.get('foo', (0, 'nonexistent', '1')))
+        self.assertIsNone(srpm_index.get('nonexistent'))
@@ -1,19 +1,17 @@
 from datetime import timedelta
-from contextlib import contextmanager
-from common import DBTest, MockDatetime, postgres_only
-from sqlalchemy import Table, Column, Integer, MetaData
+from common import DBTest, MockDatetime
 from mock import Mock, patch
 
-from koschei import models as m, scheduler
+from koschei import models as m
+from koschei.backend import Backend, get_time_priority
 from koschei.scheduler import Scheduler
 
-scheduler.datetime = MockDatetime
-
 class SchedulerTest(DBTest):
     def get_scheduler(self):
-        sched = Scheduler(db=self.s, koji_session=Mock(), backend=Mock())
-        sched.lock_package_table = lambda: None
-        return sched
+        return Scheduler(db=self.s, koji_session=Mock(), backend=Mock())
+
+    def get_backend(self):
+        return Backend(db=self.s, koji_session=Mock(), log=Mock())
 
     def prepare_depchanges(self):
         pkg, build = self.prepare_basic_data()
@@ -50,160 +48,163 @@ class SchedulerTest(DBTest):
         self.s.commit()
         return pkg, build
 
-    def assert_priority_query(self, query):
-        columns = query.subquery().c
-        self.assertIn('pkg_id', columns)
-        self.assertIn('priority', columns)
-        self.assertEqual(2, len(columns))
-
     def test_dependency_priority(self):
-        pkg, _ = self.prepare_depchanges()
-        query = self.get_scheduler().get_dependency_priority_query()
-        self.assert_priority_query(query)
-        res = query.all()
-        self.assertIn((pkg.id, 20), res)
-        self.assertIn((pkg.id, 10), res)
-        self.assertIn((pkg.id, 5), res)
-        self.assertIn((pkg.id, 2), res)
-        self.assertEqual(4, len(res))
-
-    @postgres_only
-    def test_time_priority(self):
-        for days in [0, 2, 5, 7, 12]:
-            pkg = m.Package(name='p{}'.format(days))
-            self.s.add(pkg)
-            self.s.flush()
-            build = m.Build(package_id=pkg.id,
-                            started=MockDatetime.now() - timedelta(days, hours=1))
-            self.s.add(build)
+        pkg, build = self.prepare_depchanges()
+        pkg.manual_priority = 100
         self.s.commit()
-        query = self.get_scheduler().get_time_priority_query()
-        self.assert_priority_query(query)
-        res = sorted(query.all(), key=lambda x: x.priority)
-        self.assertEqual(5, len(res))
+        backend = self.get_backend()
+        backend.update_dependency_priorities()
+        self.s.commit()
+        self.assertEqual(37, pkg.dependency_priority)
+        self.assertEqual(137, pkg.current_priority)
+        backend.flush_depchanges(build)
+        self.s.commit()
+        self.assertEqual(0, pkg.dependency_priority)
+        self.assertEqual(100, pkg.current_priority)
+
+    def test_time_priority(self):
         expected_prios = [-30.0, 161.339324401, 230.787748579,
                           256.455946637, 297.675251883]
-        for item, exp in zip(res, expected_prios):
-            self.assertAlmostEqual(exp, item.priority)
+        for days, exp in zip([0, 2, 5, 7, 12], expected_prios):
+            self.assertAlmostEqual(exp, get_time_priority(days * 24 + 1))
+
+    def test_update_time_priorities(self):
+        pkgs = self.prepare_packages(['rnv', 'eclipse', 'fop'])
+        for pkg, days in (pkgs[0], 5), (pkgs[0], 2), (pkgs[1], 12):
+            self.s.add(m.Build(package_id=pkg.id,
+                               started=MockDatetime.now() -
+                               timedelta(days, hours=1)))
+        self.s.commit()
+        with patch('koschei.backend.datetime', MockDatetime):
+            self.get_backend().update_time_priorities()
+        self.s.commit()
+        self.assertEqual([161, 298, 0], [pkg.time_priority for pkg in pkgs])
+        self.assertEqual([161, 298, 0], [pkg.current_priority for pkg in pkgs])
 
-    @postgres_only
     def test_failed_build_priority(self):
         pkgs = self.prepare_packages(['rnv', 'eclipse', 'fop', 'freemind', 'i3'])
         self.prepare_builds(rnv=True, eclipse=False, i3=True, freemind=False)
         self.prepare_builds(rnv=False, eclipse=False, fop=False, freemind=False)
         self.prepare_builds(freemind=False)
-        query = self.get_scheduler().get_failed_build_priority_query()
+        backend = self.get_backend()
+        backend.update_failed_priorities([pkg.id for pkg in pkgs])
+        self.s.commit()
         # fop has 1 failed build with no previous one, should it be prioritized?
-        # self.assertItemsEqual([(pkgs[0].id, 200), (pkgs[1].id, 200)],
-        #                       query.all())
-        self.assertItemsEqual([(pkgs[0].id, 200)], query.all())
-
-    @contextmanager
-    def prio_table(self, tablename='tmp', **kwargs):
-        try:
-            table = Table(tablename, MetaData(),
-                          Column('pkg_id', Integer), Column('priority', Integer))
-            conn = self.s.connection()
-            table.create(bind=conn)
-            priorities = {name: prio for name, prio in kwargs.items() if '_' not in name}
-            builds = {name[:-len("_build")]: state for name, state in kwargs.items()
-                      if name.endswith('_build')}
-            states = {name[:-len('_state')]: state for name, state in kwargs.items()
-                      if name.endswith('_state')}
-            pkgs = []
-            for name in priorities.keys():
-                pkg = self.s.query(m.Package).filter_by(name=name).first()
-                if not pkg:
-                    pkg = m.Package(name=name, ignored=states.get(name) == 'ignored')
-                    self.s.add(pkg)
-                    self.s.flush()
-                    if states.get(name, True) is not None:
-                        pkg.resolved = states.get(name) != 'unresolved'
-                pkgs.append((name, pkg))
-                if name in builds:
-                    self.s.add(m.Build(package_id=pkg.id, state=builds[name]))
-            conn.execute(table.insert(), [{'pkg_id': pkg.id, 'priority': priorities[name]}
-                                          for name, pkg in pkgs])
-            self.s.commit()
-            yield table
-        finally:
-            self.s.rollback()
-            conn = self.s.connection()
-            table.drop(bind=conn)
-            self.s.commit()
-
-    def assert_scheduled(self, tables, scheduled, koji_load=0.3):
+        self.assertEqual([200, 0, 0, 0, 0],
+                         [pkg.failed_priority for pkg in pkgs])
+        self.prepare_builds(rnv=None)
+        backend.update_failed_priorities([pkgs[0].id])
+        self.s.commit()
+        self.assertEqual(0, pkgs[0].failed_priority)
+
+    def test_current_priority(self):
+        [pkg] = self.prepare_packages(['rnv'])
+        self.assertEqual(0, pkg.current_priority)
+        pkg.static_priority = 10
+        pkg.manual_priority = 20
+        self.s.commit()
+        self.assertEqual(30, pkg.current_priority)
+        self.get_backend().update_priority_component('failed_priority',
+                                                     {pkg.id: 200})
+        self.s.commit()
+        self.assertEqual(230, pkg.current_priority)
+        pkg.manual_priority = 0
+        self.s.commit()
+        self.assertEqual(210, pkg.current_priority)
+
+    def test_time_refresh(self):
+        sched = self.get_scheduler()
+        with patch('koschei.util.get_koji_load', Mock(return_value=0.3)):
+            sched.get_scheduled_package()
+            sched.get_scheduled_package()
+        sched.backend.update_time_priorities.assert_called_once_with()
+
+    def prepare_priorities(self, component='manual_priority', **kwargs):
+        priorities = {name: prio for name, prio in kwargs.items() if '_' not in name}
+        builds = {name[:-len("_build")]: state for name, state in kwargs.items()
+                  if name.endswith('_build')}
+        states = {name[:-len('_state')]: state for name, state in kwargs.items()
+                  if name.endswith('_state')}
+        for name, priority in priorities.items():
+            pkg = self.s.query(m.Package).filter_by(name=name).first()
+            if not pkg:
+                pkg = m.Package(name=name, ignored=states.get(name) == 'ignored')
+                self.s.add(pkg)
+                if states.get(name, True) is not None:
+                    pkg.resolved = states.get(name) != 'unresolved'
+            setattr(pkg, component, priority)
+            self.s.flush()
+            if name in builds:
+                self.s.add(m.Build(package_id=pkg.id, state=builds[name]))
+        self.s.commit()
+
+    def assert_scheduled(self, scheduled, koji_load=0.3):
         with patch('koschei.util.get_koji_load',
                    Mock(return_value=koji_load)):
-            sched = self.get_scheduler()
-            def get_prio_q():
-                return {i :self.s.query(t.c.pkg_id.label('pkg_id'), t.c.priority.label('priority'))
-                        for i, t in enumerate(tables)}
-            with patch.object(sched, 'get_priority_queries', get_prio_q):
-                pkg = sched.get_scheduled_package()
-                if scheduled:
-                    self.assertEqual(scheduled, pkg.name)
-                else:
-                    self.assertIsNone(pkg)
+            pkg = self.get_scheduler().get_scheduled_package()
+            if scheduled:
+                self.assertEqual(scheduled, pkg.name)
+            else:
+                self.assertIsNone(pkg)
 
     def test_low(self):
-        with self.prio_table(rnv=10) as table:
-            self.assert_scheduled([table], scheduled=None)
+        self.prepare_priorities(rnv=10)
+        self.assert_scheduled(scheduled=None)
 
     def test_submit1(self):
-        with self.prio_table(rnv=256) as table:
-            self.assert_scheduled([table], scheduled='rnv')
+        self.prepare_priorities(rnv=256)
+        self.assert_scheduled(scheduled='rnv')
 
     def test_submit_no_resolution(self):
-        with self.prio_table(rnv=256, rnv_state=None) as table:
-            self.assert_scheduled([table], scheduled='rnv')
+        self.prepare_priorities(rnv=256, rnv_state=None)
+        self.assert_scheduled(scheduled='rnv')
 
     def test_load(self):
-        with self.prio_table(rnv=30000) as table:
-            self.assert_scheduled([table], koji_load=0.7, scheduled=None)
+        self.prepare_priorities(rnv=30000)
+        self.assert_scheduled(koji_load=0.7, scheduled=None)
 
     def test_max_builds(self):
-        with self.prio_table(rnv=30, rnv_build=m.Build.RUNNING,
-                             eclipse=300, eclipse_build=m.Build.RUNNING,
-                             expat=400) as table:
-            self.assert_scheduled([table], scheduled=None)
+        self.prepare_priorities(rnv=30, rnv_build=m.Build.RUNNING,
+                                eclipse=300, eclipse_build=m.Build.RUNNING,
+                                expat=400)
+        self.assert_scheduled(scheduled=None)
 
     def test_running1(self):
-        with self.prio_table(rnv=30000, rnv_build=m.Build.RUNNING) as table:
-            self.assert_scheduled([table], scheduled=None)
+        self.prepare_priorities(rnv=30000, rnv_build=m.Build.RUNNING)
+        self.assert_scheduled(scheduled=None)
 
     def test_running2(self):
-        with self.prio_table(eclipse=100, rnv=300, rnv_build=m.Build.RUNNING) as table:
-            self.assert_scheduled([table], scheduled=None)
+        self.prepare_priorities(eclipse=100, rnv=300, rnv_build=m.Build.RUNNING)
+        self.assert_scheduled(scheduled=None)
 
     def test_running3(self):
-        with self.prio_table(eclipse=280, rnv=300, rnv_build=m.Build.RUNNING) as table:
-            self.assert_scheduled([table], scheduled='eclipse')
+        self.prepare_priorities(eclipse=280, rnv=300, rnv_build=m.Build.RUNNING)
+        self.assert_scheduled(scheduled='eclipse')
 
     def test_multiple(self):
-        with self.prio_table(eclipse=280, rnv=300) as table:
-            self.assert_scheduled([table], scheduled='rnv')
+        self.prepare_priorities(eclipse=280, rnv=300)
+        self.assert_scheduled(scheduled='rnv')
 
     def test_builds(self):
-        with self.prio_table(eclipse=100, rnv=300, rnv_build=m.Build.COMPLETE,
-                             eclipse_build=m.Build.RUNNING) as table:
-            self.assert_scheduled([table], scheduled='rnv')
+        self.prepare_priorities(eclipse=100, rnv=300, rnv_build=m.Build.COMPLETE,
+                                eclipse_build=m.Build.RUNNING)
+        self.assert_scheduled(scheduled='rnv')
 
     def test_state1(self):
-        with self.prio_table(rnv=300, rnv_state='unresolved') as table:
-            self.assert_scheduled([table], scheduled=None)
+        self.prepare_priorities(rnv=300, rnv_state='unresolved')
+        self.assert_scheduled(scheduled=None)
 
     def test_state2(self):
-        with self.prio_table(rnv=300, rnv_state='ignored') as table:
-            self.assert_scheduled([table], scheduled=None)
+        self.prepare_priorities(rnv=300, rnv_state='ignored')
+        self.assert_scheduled(scheduled=None)
 
     def test_union1(self):
-        with self.prio_table(tablename='tmp1', rnv=100) as table1:
-            with self.prio_table(tablename='tmp2', eclipse=280, rnv=200) as table2:
-                self.assert_scheduled([table1, table2], scheduled='rnv')
+        self.prepare_priorities(rnv=100)
+        self.prepare_priorities('static_priority', eclipse=280, rnv=200)
+        self.assert_scheduled(scheduled='rnv')
 
     def test_union2(self):
-        with self.prio_table(tablename='tmp1', rnv=100) as table1:
-            with self.prio_table(tablename='tmp2', eclipse=300, rnv=200) as table2:
-                with self.prio_table(tablename='tmp3', eclipse=201, rnv=200) as table3:
-                    self.assert_scheduled([table1, table2, table3], scheduled='eclipse')
+        self.prepare_priorities(rnv=100)
+        self.prepare_priorities('static_priority', eclipse=300, rnv=200)
+        self.prepare_priorities('dependency_priority', eclipse=201, rnv=200)
+        self.assert_scheduled(scheduled='eclipse')
@@ -1,10 +1,19 @@
+import itertools
 import os
 import shutil
+import subprocess
+import time
+
+from multiprocessing.pool import ThreadPool
 
 from mock import Mock, patch
 from common import AbstractTest, datadir
 
-from koschei import srpm_cache
+from koschei import srpm_cache, util
+
+def touch(path):
+    open(path, 'w').close()
+    return path
 
 class SrpmCacheTest(AbstractTest):
     def setUp(self):
@@ -22,17 +31,221 @@ class SrpmCacheTest(AbstractTest):
 
     def test_download(self):
         koji_mock = Mock()
-        tag_listing = self.get_json_data('list_tagged_eclipse.json')
-        rpm_listing = self.get_json_data('list_rpms_eclipse.json')
-        koji_mock.listTagged.return_value = tag_listing
-        koji_mock.listRPMs.return_value = rpm_listing
+        [rpm_info] = self.get_json_data('list_rpms_eclipse.json')
+        koji_mock.multiCall.return_value = [[rpm_info]]
         cache = srpm_cache.SRPMCache(koji_mock)
-        with patch('koschei.util.download_rpm_header') as dl_mock:
-            rpm_path = 'srpms/eclipse-4.4.0-11.fc22.src.rpm'
-            dl_mock.return_value = rpm_path
+        rpm_path = 'srpms/eclipse-4.4.0-10.fc22.src.rpm'
+        with patch('koschei.util.download_rpm_headers',
+                   return_value=[touch(rpm_path)]) as dl_mock:
             self.assertEqual(rpm_path, cache.get_srpm('eclipse', 1, '4.4.0', '10.fc22'))
-        koji_mock.listTagged.assert_called_once_with('f22', package='eclipse')
-        koji_mock.listRPMs.assert_called_once_with(buildID=548392, arches='src')
+        koji_mock.getRPM.assert_called_once_with('eclipse-4.4.0-10.fc22.src')
         dl_mock.assert_called_once_with(
-                'koji.fake/packages/eclipse/4.4.0/10.fc22/src/eclipse-4.4.0-10.fc22.src.rpm',
+                ['koji.fake/packages/eclipse/4.4.0/10.fc22/src/eclipse-4.4.0-10.fc22.src.rpm'],
                 'srpms')
+
+    def test_get_srpms(self):
+        koji_mock = Mock()
+        [rpm_info] = self.get_json_data('list_rpms_eclipse.json')
+        koji_mock.multiCall.return_value = [[rpm_info], [None], [rpm_info]]
+        cache = srpm_cache.SRPMCache(koji_mock)
+        with patch('koschei.util.download_rpm_headers',
+                   return_value=[touch('srpms/eclipse.src.rpm')]) as dl_mock:
+            cache.get_srpms([('rnv', None, '1.7.11', '6.fc21'),
+                             ('eclipse', 1, '4.4.0', '10.fc22'),
+                             ('eclipse', 1, '4.4.0', '10.fc22'),
+                             ('nonexistent', None, '1', '1'),
+                             ('eclipse', 2, '4.4.0', '10.fc22')])
+        self.assertEqual(3, koji_mock.getRPM.call_count)
+        self.assertEqual(1, len(dl_mock.call_args[0][0]))
+        self.assertEqual('srpms/eclipse.src.rpm',
+                         cache.get_srpm('eclipse', 1, '4.4.0', '10.fc22'))
+
+    def test_index(self):
+        srpm_cache.SRPMCache(None)
+        self.assertTrue(os.path.exists('srpms/srpm_index.sqlite'))
+        with patch('rpm.TransactionSet') as ts_mock:
+            cache = srpm_cache.SRPMCache(None)
+        self.assertFalse(ts_mock.return_value.hdrFromFdno.called)
+        self.assertEqual('srpms/rnv-1.7.11-6.fc21.src.rpm',
+                         cache.get_srpm('rnv', None, '1.7.11', '6.fc21'))
+        self.assertEqual('srpms/aether-1.0.0-3.fc21.src.rpm',
+                         cache.get_srpm('aether', 1, '1.0.0', '3.fc21'))
+
+    def test_index_outdated(self):
+        srpm_cache.SRPMCache(None)
+        os.unlink('srpms/xpp3-1.1.4-3.c.fc21.src.rpm')
+        shutil.copy('srpms/rnv-1.7.11-6.fc21.src.rpm',
+                    'srpms/aether-1.0.0-3.fc21.src.rpm')
+        cache = srpm_cache.SRPMCache(None)
+        self.assertEqual({('rnv', None, '1.7.11', '6.fc21')},
+                         set(cache._cache))
+        self.assertEqual(['aether-1.0.0-3.fc21.src.rpm',
+                          'rnv-1.7.11-6.fc21.src.rpm'],
+                         [name for [name] in cache._index.execute(
+                             "SELECT filename FROM srpm ORDER BY filename")])
+
+    def add_srpms(self, cache, *nevrs):
+        srpms = [{'build_id': i, 'name': name, 'epoch': epoch,
+                  'version': version, 'release': release, 'arch': 'src'}
+                 for i, (name, epoch, version, release) in enumerate(nevrs)]
+        cache._koji_session.multiCall.return_value = \
+            [[[srpm]] for srpm in srpms]
+        paths = [touch('srpms/{name}-{version}-{release}.src.rpm'
+                       .format(**srpm)) for srpm in srpms]
+        with patch('koschei.util.download_rpm_headers', return_value=paths):
+            cache.get_latest_srpms(srpms)
+
+    def test_evict_old(self):
+        cache = srpm_cache.SRPMCache(Mock(), keep=1, max_size=0)
+        self.add_srpms(cache, ('rnv', None, '1.7.10', '1.fc21'),
+                       ('rnv', None, '1.7.11', '1.fc21'),
+                       ('xpp3', None, '1.1.3', '1.fc21'))
+        cache.evict(protected={('xpp3', None, '1.1.3', '1.fc21')})
+        self.assertFalse(os.path.exists('srpms/rnv-1.7.10-1.fc21.src.rpm'))
+        self.assertFalse(os.path.exists('srpms/rnv-1.7.11-1.fc21.src.rpm'))
+        self.assertEqual({('rnv', None, '1.7.11', '6.fc21'),
+                          ('xpp3', None, '1.1.4', '3.c.fc21'),
+                          ('xpp3', None, '1.1.3', '1.fc21'),
+                          ('aether', 1, '1.0.0', '3.fc21')},
+                         set(cache._cache))
+        self.assertTrue(cache._dirty)
+        cache = srpm_cache.SRPMCache(None)
+        self.assertEqual(4, len(cache._cache))
+
+    def test_evict_size(self):
+        with patch('time.time', side_effect=itertools.count().next):
+            cache = srpm_cache.SRPMCache(None, keep=0,
+                                         max_size=11000 / 1024.0 / 1024.0)
+            cache.get_srpm('rnv', None, '1.7.11', '6.fc21')
+            cache.get_srpm('aether', 1, '1.0.0', '3.fc21')
+            cache.evict()
+        self.assertEqual({('rnv', None, '1.7.11', '6.fc21'),
+                          ('aether', 1, '1.0.0', '3.fc21')},
+                         set(cache._cache))
+        self.assertFalse(os.path.exists('srpms/xpp3-1.1.4-3.c.fc21.src.rpm'))
+
+    def test_evict_size_protected(self):
+        cache = srpm_cache.SRPMCache(None, keep=0, max_size=1 / 1024.0)
+        cache.evict(protected={('rnv', None, '1.7.11', '6.fc21')})
+        self.assertEqual({('rnv', None, '1.7.11', '6.fc21')},
+                         set(cache._cache))
+
+    def test_evict_size_keeps_latest(self):
+        cache = srpm_cache.SRPMCache(Mock(), keep=2, max_size=1 / 1024.0)
+        self.add_srpms(cache, ('rnv', None, '1.7.10', '1.fc21'),
+                       ('rnv', None, '1.7.9', '1.fc21'))
+        cache.evict(tracked={'rnv', 'xpp3'})
+        # aether isn't tracked, the oldest rnv is beyond keep
+        self.assertEqual({('rnv', None, '1.7.11', '6.fc21'),
+                          ('rnv', None, '1.7.10', '1.fc21'),
+                          ('xpp3', None, '1.1.4', '3.c.fc21')},
+                         set(cache._cache))
+        self.assertFalse(os.path.exists('srpms/aether-1.0.0-3.fc21.src.rpm'))
+
+    def read_rnv(self):
+        with open('srpms/rnv-1.7.11-6.fc21.src.rpm', 'rb') as rpm_file:
+            return rpm_file.read()
+
+    def test_header_size(self):
+        data = self.read_rnv()
+        self.assertEqual(3676, util.get_rpm_header_size(data))
+        self.assertIsNone(util.get_rpm_header_size(data[:200]))
+        self.assertRaises(IOError, util.get_rpm_header_size, 'x' * 200)
+
+    def test_fetch_header_range(self):
+        data = self.read_rnv()
+        session = Mock()
+        session.get.return_value.status_code = 206
+        session.get.return_value.content = data
+        url = 'http://example.com/rnv-1.7.11-6.fc21.src.rpm'
+        self.assertEqual(data[:3676], util.fetch_rpm_header(url, session))
+        session.get.assert_called_once_with(url, stream=True, timeout=60,
+                                            headers={'Range': 'bytes=0-65535'})
+
+    def test_fetch_header_no_range(self):
+        data = self.read_rnv()
+        session = Mock()
+        session.get.return_value.status_code = 200
+        session.get.return_value.iter_content.return_value = \
+            [data[:1000], data[1000:], 'rest of the file']
+        url = 'http://example.com/rnv-1.7.11-6.fc21.src.rpm'
+        self.assertEqual(data[:3676], util.fetch_rpm_header(url, session))
+        self.assertTrue(session.get.return_value.close.called)
+
+    def test_http_session_shared(self):
+        def create_session():
+            # widens the window for concurrent creation
+            time.sleep(0.01)
+            return Mock()
+        pool = ThreadPool(8)
+        with patch('koschei.util._http_session', None):
+            with patch('requests.Session',
+                       side_effect=create_session) as session_mock:
+                sessions = pool.map(lambda _: util.get_http_session(),
+                                    range(8))
+        pool.close()
+        pool.join()
+        self.assertEqual(1, session_mock.call_count)
+        self.assertEqual(1, len(set(sessions)))
+
+    def test_latest_srpms(self):
+        koji_mock = Mock()
+        koji_mock.multiCall.return_value = \
+            [[self.get_json_data('list_rpms_eclipse.json')]]
+        cache = srpm_cache.SRPMCache(koji_mock)
+        rpm_path = 'srpms/eclipse-4.4.0-10.fc22.src.rpm'
+        with patch('koschei.util.download_rpm_headers',
+                   return_value=[touch(rpm_path)]) as dl_mock:
+            cache.get_latest_srpms([{'build_id': 548392, 'name': 'eclipse',
+                                     'version': '4.4.0', 'release': '10.fc22',
+                                     'epoch': 1}])
+        dl_mock.assert_called_once_with(
+            ['koji.fake/packages/eclipse/4.4.0/10.fc22/src/eclipse-4.4.0-10.fc22.src.rpm'],
+            'srpms')
+        self.assertEqual(rpm_path, cache.get_srpm('eclipse', 1, '4.4.0', '10.fc22'))
+
+    def test_createrepo_update(self):
+        os.mkdir('srpms/repodata')
+        cache = srpm_cache.SRPMCache(None)
+        self.assertTrue(os.path.exists('srpms/repodata'))
+        with patch('subprocess.Popen') as popen_mock:
+            popen_mock.return_value.communicate.return_value = ('', '')
+            popen_mock.return_value.wait.return_value = 0
+            with patch('librepo.Handle'):
+                cache.get_repodata()
+                cache.get_repodata()
+        popen_mock.assert_called_once_with(['createrepo_c', '--update',
+                                            '--skip-stat', '--no-database',
+                                            'srpms'],
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE)
+
+    def test_view(self):
+        cache = srpm_cache.SRPMCache(Mock())
+        self.add_srpms(cache, ('rnv', None, '1.7.10', '1.fc21'))
+        with patch('subprocess.Popen') as popen_mock:
+            popen_mock.return_value.communicate.return_value = ('', '')
+            popen_mock.return_value.wait.return_value = 0
+            with patch('librepo.Handle') as handle_mock:
+                get_view = lambda: cache.get_repodata(
+                    view='latest', names=['rnv', 'aether'],
+                    nevrs=[('xpp3', None, '1.1.4', '3.c.fc21')])
+                get_view()
+                os.mkdir('srpms/views/latest/repodata')
+                get_view()
+        self.assertEqual(['srpms/views/latest'], handle_mock.return_value.urls)
+        self.assertEqual(2, popen_mock.call_count)
+        popen_mock.assert_called_with(['createrepo_c', '--update',
+                                       '--skip-stat', '--no-database',
+                                       '--pkglist',
+                                       'srpms/views/latest/pkglist',
+                                       '--update-md-path', 'srpms',
+                                       '--outputdir', 'srpms/views/latest',
+                                       'srpms'],
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE)
+        with open('srpms/views/latest/pkglist') as pkglist:
+            self.assertEqual(['aether-1.0.0-3.fc21.src.rpm',
+                              'rnv-1.7.11-6.fc21.src.rpm',
+                              'xpp3-1.1.4-3.c.fc21.src.rpm'],
+                             pkglist.read().split())